@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Iterable
+import asyncio
+import time
+import os
+
+def get_mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+# bounded lru cache with ttl, every entry records the files contributing to it
+# and becomes invalid once any of those files is modified
+class ResultCache:
+    def __init__(self, max_size: int = 512, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (result, {path: mtime}, expire time)
+        self.entries: OrderedDict[Hashable, tuple[Any, dict[str, int], float]] = OrderedDict()
+        # off while a watcher clears the cache on changes, stating every file
+        # of a huge result on each hit is slow
+        self.check_files = True
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Any:
+        entry = self.entries.get(key, None)
+
+        if None == entry:
+            self.misses += 1
+            return None
+
+        result, files, expire = entry
+
+        # expired, or some file has been modified after the result is recorded
+        if time.monotonic() > expire or \
+            (self.check_files and any(get_mtime(path) != mtime for path, mtime in files.items())):
+            del self.entries[key]
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key: Hashable, result: Any, files: Iterable[str]):
+        if self.max_size <= 0:
+            return
+
+        mtimes = {path: get_mtime(path) for path in set(files)} if self.check_files else {}
+        self.entries[key] = (result, mtimes, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+
+        # evict least recently used entries
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+# coalesce identical concurrent calls, only the first caller runs the call and
+# all callers with the same key share its result. every caller waits by its own
+# timeout, with cancel_abandoned the call is canceled once nobody waits for it
+class SingleFlight:
+    def __init__(self, cancel_abandoned: bool = False):
+        self.flights: dict[Hashable, asyncio.Task] = {}
+        # task -> number of callers waiting for it
+        self.waiters: dict[asyncio.Task, int] = {}
+        self.cancel_abandoned = cancel_abandoned
+        self.shared = 0
+
+    def __done_cb(self, key: Hashable, task: asyncio.Task):
+        if self.flights.get(key, None) is task:
+            del self.flights[key]
+
+        # every waiter might be gone, mark the exception retrieved
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable], timeout: float = None) -> Any:
+        task = self.flights.get(key, None)
+
+        if None == task:
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda task: self.__done_cb(key, task))
+            self.flights[key] = task
+        else:
+            self.shared += 1
+
+        self.waiters[task] = self.waiters.get(task, 0) + 1
+        try:
+            # a canceled or timed out waiter should not cancel the call shared with others
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        finally:
+            self.waiters[task] -= 1
+            if 0 == self.waiters[task]:
+                del self.waiters[task]
+                if self.cancel_abandoned and not task.done():
+                    task.cancel()
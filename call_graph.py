@@ -0,0 +1,135 @@
+from typing import Awaitable, Callable, Hashable, Union
+import asyncio
+
+from locations import FileTable
+
+DIRECTIONS = ('incoming', 'outgoing', 'both')
+
+# a function is identified by the symbol id clangd puts in data, which its
+# prototype and definition share, or else by the position of its name
+def item_key(item: dict) -> Hashable:
+    if item.get('data', None):
+        return item['data']
+
+    start = item['selectionRange']['start']
+    return (item['uri'], start['line'], start['character'])
+
+# functions reached from the root functions and the calls between them, edges
+# always point from caller to callee whatever direction the graph is expanded
+class CallGraph:
+    def __init__(self, files: FileTable, max_nodes: int = 200):
+        self.files = files
+        self.max_nodes = max_nodes
+        # node id -> call hierarchy item, items are sent back to clangd as is
+        self.items: list[dict] = []
+        self.file_ids: list[int] = []
+        self.node_ids: dict[Hashable, int] = {}
+        # (caller, callee) -> number of call sites
+        self.edges: dict[tuple[int, int], int] = {}
+        # some node was dropped by max_nodes
+        self.truncated = False
+        # number of expand requests that failed, their neighbours are missing
+        self.errors = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def add_node(self, item: dict) -> Union[int, None]:
+        key = item_key(item)
+        node = self.node_ids.get(key, None)
+
+        if None != node:
+            return node
+
+        if len(self.items) >= self.max_nodes:
+            self.truncated = True
+            return None
+
+        node = len(self.items)
+        self.items.append(item)
+        self.file_ids.append(self.files.intern_uri(item['uri']))
+        self.node_ids[key] = node
+        return node
+
+    def add_edge(self, caller: int, callee: int, count: int):
+        # the same call might be reported by several shards
+        self.edges[(caller, callee)] = max(count, self.edges.get((caller, callee), 0))
+
+    def to_dict(self) -> dict:
+        return {
+            'nodes': [{
+                'name': item['name'],
+                'location': f'{self.files.relative(file_id)}:{item['selectionRange']['start']['line']}',
+            } for item, file_id in zip(self.items, self.file_ids)],
+            # [caller, callee, call sites], callers and callees are node indexes
+            'edges': [[caller, callee, count] for (caller, callee), count in self.edges.items()],
+            'truncated': self.truncated,
+            'errors': self.errors,
+        }
+
+# level by level bfs, every level is fetched concurrently but at most
+# concurrency requests are in flight on the connection at once
+async def expand(graph: CallGraph, roots: list[int], fetch: Callable[[dict], Awaitable[list]],
+                 incoming: bool, depth: int, concurrency: int = 8):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    # callers are in the from field of incoming calls, callees in the to field
+    peer = 'from' if incoming else 'to'
+
+    async def visit(node: int) -> list:
+        async with semaphore:
+            return await fetch(graph.items[node])
+
+    visited = set(roots)
+    frontier = list(roots)
+
+    for _ in range(depth):
+        if not frontier:
+            break
+
+        results = await asyncio.gather(*[visit(node) for node in frontier], return_exceptions=True)
+        next_frontier = []
+
+        for node, calls in zip(frontier, results):
+            if isinstance(calls, BaseException):
+                graph.errors += 1
+                continue
+
+            for call in calls:
+                other = graph.add_node(call[peer])
+                if None == other:
+                    continue
+
+                if incoming:
+                    graph.add_edge(other, node, len(call['fromRanges']))
+                else:
+                    graph.add_edge(node, other, len(call['fromRanges']))
+
+                if other not in visited:
+                    visited.add(other)
+                    next_frontier.append(other)
+
+        frontier = next_frontier
+
+def check_calls(response: dict) -> list:
+    # no call is not an error here, a leaf function has no callees
+    if 'error' in response:
+        raise RuntimeError(f'error occur: {response['error'].get('message', '')}')
+
+    return response.get('result', None) or []
+
+# calls reported by every shard, a failed shard is skipped unless all failed
+def merge_calls(responses: list, peer: str) -> list:
+    merged = {}
+    errors = [response for response in responses if isinstance(response, BaseException)]
+
+    if len(errors) == len(responses):
+        raise errors[0]
+
+    for response in responses:
+        if isinstance(response, BaseException):
+            continue
+
+        for call in check_calls(response):
+            merged.setdefault(item_key(call[peer]), call)
+
+    return list(merged.values())
@@ -0,0 +1,135 @@
+from array import array
+from typing import Iterator, Union
+import threading
+import json
+import mmap
+import os
+import re
+import shlex
+import sys
+
+# one entry of compile_commands.json, entries are flat objects so a brace can
+# only appear inside a string, possessive quantifiers avoid backtracking
+ENTRY_PATTERN = re.compile(rb'\{[^"{}]*+(?:"(?:[^"\\]++|\\.)*+"[^"{}]*+)*+\}')
+# "file" and "directory" fields inside an entry
+FIELD_PATTERN = re.compile(rb'"(file|directory)"\s*:\s*"((?:[^"\\]++|\\.)*+)"')
+
+def command_arguments(entry: dict, windows: bool = sys.platform == 'win32') -> list[str]:
+    if 'arguments' in entry:
+        return entry['arguments']
+
+    if not windows:
+        return shlex.split(entry['command'])
+
+    # posix rules take backslashes of windows paths as escapes, windows rules
+    # only group by double quotes, which are not part of the argument
+    return [arg[1:-1] if len(arg) > 1 and '"' == arg[0] == arg[-1] else arg
+            for arg in shlex.split(entry['command'], posix=False)]
+
+# streaming reader of compile_commands.json, the file is mapped instead of
+# loaded, entries are decoded only when they are asked for
+class CompileDatabase:
+    def __init__(self, cdb_file: str):
+        self.cdb_file = os.path.abspath(cdb_file)
+        self.file = open(self.cdb_file, 'rb')
+        # mmap cannot map an empty file
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mmap = b''
+
+        # source file of every entry, and the byte range of the entry
+        self.files: list[str] = []
+        self.offsets = array('Q')
+        # source file -> entry number
+        self.file_index: dict[str, int] = {}
+
+        self.indexed = False
+        self.closing = False
+        self.index_lock = threading.Lock()
+
+    def close(self):
+        # stop the index builder first, the mmap is in use by it
+        self.closing = True
+        with self.index_lock:
+            if isinstance(self.mmap, mmap.mmap):
+                self.mmap.close()
+            self.file.close()
+
+    def __len__(self):
+        return len(self.files)
+
+    def spans(self) -> Iterator[tuple[int, int]]:
+        for match in ENTRY_PATTERN.finditer(self.mmap):
+            yield match.span()
+
+    def decode(self, start: int, end: int) -> dict:
+        return json.loads(self.mmap[start:end])
+
+    def entries(self) -> Iterator[dict]:
+        for start, end in self.spans():
+            yield self.decode(start, end)
+
+    def first_entry(self) -> dict:
+        for entry in self.entries():
+            return entry
+
+        raise RuntimeError(f'{self.cdb_file} has no entry')
+
+    @staticmethod
+    def unescape(value: bytes) -> str:
+        if b'\\' in value:
+            return json.loads(b'"' + value + b'"')
+        return value.decode()
+
+    def build_index(self):
+        with self.index_lock:
+            if self.indexed:
+                return
+
+            for start, end in self.spans():
+                if self.closing:
+                    return
+
+                # fields are only searched inside complete entries, a file still
+                # being written ends with a truncated one
+                values = {field.group(1): field.group(2) for field in FIELD_PATTERN.finditer(self.mmap, start, end)}
+
+                file = os.path.normpath(os.path.join(
+                    self.unescape(values.get(b'directory', b'')),
+                    self.unescape(values.get(b'file', b''))))
+
+                # first entry wins when a file is compiled more than once
+                self.file_index.setdefault(file, len(self.files))
+                self.files.append(file)
+                self.offsets.extend((start, end))
+
+            self.indexed = True
+
+    def entry(self, index: int) -> dict:
+        return self.decode(self.offsets[index * 2], self.offsets[index * 2 + 1])
+
+    def write_subset(self, indexes: list[int], path: str):
+        # copy raw entries, no need to decode and encode them again
+        with open(path, 'wb') as f:
+            f.write(b'[\n')
+            for n, index in enumerate(indexes):
+                if n > 0:
+                    f.write(b',\n')
+                f.write(self.mmap[self.offsets[index * 2]:self.offsets[index * 2 + 1]])
+            f.write(b'\n]\n')
+
+    def entry_for(self, file: str) -> Union[dict, None]:
+        index = self.file_index.get(os.path.normpath(file), None)
+
+        if None == index:
+            return None
+
+        return self.entry(index)
+
+    def entries_under(self, directory: str) -> Iterator[dict]:
+        directory = os.path.join(os.path.normpath(directory), '')
+
+        for index, file in enumerate(self.files):
+            if file.startswith(directory):
+                yield self.entry(index)
@@ -1,129 +1,322 @@
-from collections import deque
-from typing import Union
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Awaitable, Callable, Union
 
+import itertools
 import json
 import os, sys
+import re
 import asyncio
 import logging
 import time
+import uuid
 import clangd_utils
+from symbol_store import SymbolStore
+from symbol_index import SymbolIndex, SymbolFilter, describe_symbol, kind_number
+from cache import ResultCache, SingleFlight
+from cdb import CompileDatabase, command_arguments
+from locations import FileTable, LocationList
+from watcher import FileWatcher, CHANGED, DELETED
+from git_head import GitHead
+import call_graph
+import program_graph
+import watcher
+
+logger_configured = False
+
+# changed files parsed again before lookups go on, the rest are parsed in
+# background
+REFRESH_LIMIT = 8
+# seconds to let clangd reparse edited files before symbols are reloaded
+SYMBOL_REFRESH_DELAY = 5
+# symbols of more changed files than this are reloaded from the whole clangd
+# index instead of being asked file by file
+SYMBOL_REFRESH_LIMIT = 64
+# document symbols leave macros out, they are read from #define lines
+MACRO_PATTERN = re.compile(r'[ \t]*#[ \t]*define[ \t]+(\w+)')
+
+# monotonic time the current tool call should be answered by, 0 means no deadline
+request_deadline: ContextVar[float] = ContextVar('request_deadline', default=0)
+
+# every clangd request sent in this block, including the ones of tasks created
+# in it, gives up once the block has run for the given seconds
+@contextmanager
+def deadline(seconds: float):
+    token = request_deadline.set(time.monotonic() + seconds if seconds > 0 else 0)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+# seconds left to the deadline of the current tool call, None without one
+def remaining_time() -> Union[float, None]:
+    if request_deadline.get() > 0:
+        return max(0, request_deadline.get() - time.monotonic())
+    return None
+
+# tasks outliving the tool call that starts them, they do not inherit its deadline
+def background_task(coro: Awaitable, name: str) -> asyncio.Task:
+    context = copy_context()
+    context.run(request_deadline.set, 0)
+    return asyncio.create_task(coro, name=name, context=context)
+
+# runs in a worker thread, both reading and encoding a big file take a while
+def encode_did_open(file: str) -> tuple[str, bytes]:
+    with open(file, encoding='utf-8') as f:
+        text = f.read()
+
+    return text, clangd_utils.encode_message({
+        'jsonrpc': '2.0',
+        'method': 'textDocument/didOpen',
+        'params': {
+            'textDocument': {
+                'uri': clangd_utils.fn_to_uri(file),
+                'languageId': 'c',
+                'version': 1,
+                'text': text
+            }
+        },
+    })
+
+# runs in a worker thread, symbols in shared headers are reported by many shards
+def merge_symbols(responses: list[dict]) -> dict:
+    merged = {}
+    for response in responses:
+        for symbol_info in response.get('result', None) or []:
+            start = symbol_info['location']['range']['start']
+            key = (symbol_info['name'], symbol_info['location']['uri'], start['line'], start['character'])
+            merged.setdefault(key, symbol_info)
+
+    return {'result': list(merged.values())}
+
+# runs in a worker thread, turns the nested document symbols of a file into
+# workspace/symbol results. those have one location per symbol, so the largest
+# declaration of a name wins, a definition covers its body
+def flatten_document_symbols(path: str, items: list[dict]) -> list[dict]:
+    uri = clangd_utils.fn_to_uri(path)
+    found: dict[tuple, tuple] = {}
+
+    def add(name: str, kind: int, container: str, start: dict, extent: tuple):
+        key = (name, kind, container)
+        if key not in found or extent > found[key][0]:
+            found[key] = (extent, {
+                'name': name,
+                'kind': kind,
+                'containerName': container,
+                'location': {'uri': uri, 'range': {'start': start, 'end': start}},
+            })
 
-class ClangdClient:
-    def __init__(self, workspace_path: str = ''):
-        self.workspace_path = workspace_path
+    pending = [(item, '') for item in items]
+    while pending:
+        item, container = pending.pop()
+        start, end = item['range']['start'], item['range']['end']
+        add(item['name'], item['kind'], container, item['selectionRange']['start'],
+            (end['line'] - start['line'], end['character'] - start['character']))
+
+        qualified = f'{container}::{item['name']}' if container else item['name']
+        pending.extend((child, qualified) for child in item.get('children', None) or [])
+
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line, text in enumerate(f):
+            match = MACRO_PATTERN.match(text)
+            if None != match:
+                character = len(text[:match.start(1)].encode('utf-16-le')) // 2
+                add(match.group(1), kind_number('macro'), '', {'line': line, 'character': character}, (0, 0))
+
+    return [symbol for _, symbol in found.values()]
+
+# every client shares the module logger, configure it only once so a new
+# client does not truncate the log file or drop handlers of the others
+def get_logger(script_path: str) -> logging.Logger:
+    global logger_configured
+    logger = logging.getLogger(__name__)
+
+    if logger_configured:
+        return logger
+    logger_configured = True
+
+    if not os.path.exists(os.path.join(script_path, 'logs')):
+        os.mkdir(os.path.join(script_path, 'logs'))
+
+    time_tag = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime())
+
+    # default disable log
+    logger.setLevel(logging.CRITICAL)
+    for hdlr in logger.handlers:
+        logger.removeHandler(hdlr)
+
+    if len(sys.argv) > 1 and sys.argv[1].startswith('--enable-log'):
+        args = sys.argv[1].split('=')
+        if len(args) == 2:
+            logger.setLevel(logging._nameToLevel.get(args[1], logging.INFO))
+        else:
+            logger.setLevel(logging.INFO)
+        logger.addHandler(logging.FileHandler(os.path.join(script_path, 'logs', f'log-{time_tag}.txt'), mode='w'))
+
+    return logger
+
+# one clangd process and the json-rpc transport over its stdio
+class ClangdConnection:
+    def __init__(self, logger: logging.Logger, clangd_log: deque, name: str = ''):
+        self.logger = logger
+        # shared log ring of the client, lines are tagged by name
+        self.clangd_log = clangd_log
+        self.name = name
         self.id = 10
-        self.process: clangd_utils.subprocess.Popen = None
-        self.opened_files = set()
-        self.script_path = os.path.abspath(os.path.dirname(sys.argv[0]))
-        self.endl = clangd_utils.get_endl()
+        self.process: asyncio.subprocess.Process = None
+        self.framer = clangd_utils.MessageFramer()
 
         # requests or notifications that wait to be send
         self.send_queue = asyncio.Queue()
-        # requests that wait for ack
-        self.pending_queue = deque()
-
-        # recived response queue
-        self.recived_queue = asyncio.Queue()
+        # requests that wait for response, keyed by request id
+        self.pending_requests: dict[int, asyncio.Future] = {}
+        # body of those requests, resent after clangd is restarted
+        self.inflight: dict[int, dict] = {}
+        # requests given up by timeout
+        self.timed_out = 0
+
+        # called when clangd exits unexpectedly, the connection is down without it
+        self.on_exit: Callable[['ClangdConnection'], Awaitable] = None
+        self.recovering = False
+        self.stopping = False
+
+        # background index state, reported by $/progress
+        self.index_done = asyncio.Event()
+        self.index_percentage = 0
+        self.index_message = ''
         # clangd started flag
         self.clangd_started = asyncio.Event()
 
-        if not os.path.exists(os.path.join(self.script_path, 'logs')):
-            os.mkdir(os.path.join(self.script_path, 'logs'))
-
-        time_tag = time.strftime('%Y-%m-%d-%H-%M-%S', time.localtime())
-
-        self.logger = logging.getLogger(__name__)
-
-        # default disable log
-        self.logger.setLevel(logging.CRITICAL)
-        for hdlr in self.logger.handlers:
-            self.logger.removeHandler(hdlr)
-
-        if len(sys.argv) > 1 and sys.argv[1].startswith('--enable-log'):
-            args = sys.argv[1].split('=')
-            if len(args) == 2:
-                self.logger.setLevel(logging._nameToLevel.get(args[1], logging.INFO))
-            else:
-                self.logger.setLevel(logging.INFO)
-            self.logger.addHandler(logging.FileHandler(os.path.join(self.script_path, 'logs', f'log-{time_tag}.txt'), mode='w'))
-
     def __done_cb(self, task: asyncio.Task):
         try:
             task.result()
         except asyncio.CancelledError as e:
             self.logger.info(f'task: {task.get_name()} canceled')
         except Exception as e:
-            self.logger.critical(f'task encounter an error: {e.with_traceback()}')
-            asyncio.get_event_loop().stop()
-            raise e
+            self.logger.critical(f'task: {task.get_name()} encounter an error: {e}')
+
+            # both of recive and send task fail when clangd dies, recover once
+            if self.stopping or self.recovering:
+                return
+
+            if None == self.on_exit:
+                self.clangd_started.clear()
+                self.fail_pending(RuntimeError('clangd exited unexpectedly'))
+                return
+
+            self.recovering = True
+            self.recover_task = background_task(self.on_exit(self), 'recover_task')
+
+    def __start_tasks(self):
+        self.recive_task = background_task(self.__recive_task(), 'recive_task')
+        self.send_task = background_task(self.__send_task(), 'send_task')
+        self.log_task = background_task(self.__log_task(), 'log_task')
+
+        self.recive_task.add_done_callback(self.__done_cb)
+        self.send_task.add_done_callback(self.__done_cb)
+        self.log_task.add_done_callback(self.__done_cb)
+
+    async def __stop_tasks(self):
+        tasks = [self.recive_task, self.send_task, self.log_task]
+
+        for task in tasks:
+            task.cancel()
+
+        # make sure nobody reads the pipes any more
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def fail_pending(self, error: Exception):
+        # wake up all requests that still wait for response
+        for future in self.pending_requests.values():
+            if not future.done():
+                future.set_exception(error)
+
+        self.pending_requests.clear()
+        self.inflight.clear()
 
     async def __recive_task(self):
         while True:
             # clangd should be started before read any messages
             await self.clangd_started.wait()
 
-            # wait for a line is read in buffer            
-            line: bytes = await asyncio.to_thread(self.process.stdout.readline)
-            line: str = line.decode().removeprefix(self.endl)
-
-            # is a response instead of a log information
-            if line.startswith('Content-Length:'):
-                # convert length
-                length = int(line.split(':')[1].strip())
-                # skip empty line
-                self.process.stdout.readline()
-                # read remain data
-                data = self.process.stdout.read(length).decode().removesuffix(self.endl)
-                # convert to python dict
-                response: dict = json.loads(data)
-                # response with id
-                if 'id' in response:
-                    self.logger.debug(f'resp: {response}')
-
-                    # there is no pending requests
-                    if 0 == len(self.pending_queue):
-                        # workdone progress should recive
-                        if 'window/workDoneProgress/create' == response['method'] and \
-                            'backgroundIndexProgress' == response['params']['token']:
-                            self.logger.info('recived workDoneProgress/create request')
-                            await self.recived_queue.put(response)
-                            continue
-
-                        # skip this response
-                        self.logger.info(f'drop response for: {response['method']}')
-                        continue
-
-                    # peek the first request in the pending_requests list
-                    request = self.pending_queue[0]
-
-                    # id unmatched
-                    if request['id'] != request['id']:
-                        self.logger.info(f'unknow resp for id: {request['id']}')
-                        continue
-
-                    if 'method' in response:
-                        if request['method'] != response['method']:
-                            self.logger.info(f'unknow resp for: {response['method']}({request['id']})')
-                            continue
-
-                    self.logger.info(f'recive resp for {request['method']}({request['id']})')
-                    # put response to the recived queue
-                    await self.recived_queue.put(response)
-                    # remove the corresponding request
-                    self.pending_queue.popleft()
-                # no id in response
-                else:
-                    # progress report, should be recived
-                    if '$/progress' == response['method']:
-                        await self.recived_queue.put(response)
-                        continue
+            # wait for any data from clangd
+            data: bytes = await self.process.stdout.read(65536)
 
-                    self.logger.info(f'recived no id msg: {response}')
-            # not started with Content-Length, might be a log information
-            else:
-                line = line.removesuffix(self.endl)
-                if line:
-                    self.logger.debug(f'recived log: {line}')
+            if not data:
+                raise RuntimeError('clangd exited unexpectedly')
+
+            messages, logs = self.framer.feed(data)
+
+            # not framed by Content-Length, might be a log information
+            for line in logs:
+                self.logger.debug(f'recived log: {line}')
+
+            for response in messages:
+                # large payloads are left encoded by the framer
+                if isinstance(response, bytes):
+                    response = await asyncio.to_thread(json.loads, response)
+                await self.__dispatch(response)
+
+    async def __log_task(self):
+        rest = b''
+        prefix = f'[{self.name}] ' if self.name else ''
+
+        while True:
+            # clangd should be started before read any logs
+            await self.clangd_started.wait()
+
+            data: bytes = await self.process.stderr.read(65536)
+
+            # stderr closed, clangd is exiting
+            if not data:
+                return
+
+            # keep the incomplete tail line for the next read
+            lines = (rest + data).split(b'\n')
+            rest = lines.pop()
+
+            lines = [prefix + line.decode(errors='replace').rstrip('\r') for line in lines]
+            self.clangd_log.extend(lines)
+
+            # write the whole batch to the log file at once
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('clangd log:\n' + '\n'.join(lines))
+
+            # logs are low priority, let protocol messages go first
+            await asyncio.sleep(0)
+
+    async def __dispatch(self, response: dict):
+        self.logger.debug(f'resp: {response}')
+
+        # request or notification initiated by clangd
+        if 'method' in response:
+            # clangd asks for a progress token, accept it
+            if 'window/workDoneProgress/create' == response['method']:
+                self.logger.info(f'recived workDoneProgress/create: {response['params']['token']}')
+                await self._send(False, id=response['id'], result=None)
+                return
+
+            # progress report of background index
+            if '$/progress' == response['method'] and \
+                'backgroundIndexProgress' == response['params']['token']:
+                self.update_index_progress(response['params']['value'])
+                return
+
+            self.logger.info(f'drop message for: {response['method']}')
+            return
+
+        # response for a pending request, match it by id
+        future = self.pending_requests.pop(response.get('id', None), None)
+
+        if None == future:
+            self.logger.info(f'unknow resp for id: {response.get('id', None)}')
+            return
+
+        self.logger.info(f'recive resp for id: {response['id']}')
+        # request might be canceled by the caller
+        if not future.done():
+            future.set_result(response)
 
     async def __send_task(self):
         while True:
@@ -131,10 +324,16 @@ class ClangdClient:
             await self.clangd_started.wait()
             # wait for send queue data avalible
             request, need_resp = await self.send_queue.get()
-            # convert dict to json string
-            message = json.dumps(request)
-            # add message header
-            req = f'Content-Length: {len(message)}\r\n\r\n{message}'.encode()
+
+            # messages encoded by the sender are written in one go
+            if isinstance(request, list):
+                self.logger.info(f'write {len(request)} batched messages')
+                self.process.stdin.write(b''.join(request))
+                await self.process.stdin.drain()
+                continue
+
+            # convert dict to json bytes and add message header
+            req = clangd_utils.encode_message(request)
 
             if 'method' in request:
                 log_info = f'write a message: {request['method']}'
@@ -143,13 +342,11 @@ class ClangdClient:
             # request with id means this is a request instead of a notification
             if need_resp:
                 log_info += f'({request.get('id', None)})'
-                # put request into pending queue waitting for response
-                self.pending_queue.append(request)
             self.logger.info(log_info)
 
-            # write formated message and flush write buffer
-            await asyncio.to_thread(self.process.stdin.write, req)
-            await asyncio.to_thread(self.process.stdin.flush)
+            # write formated message and wait for the write buffer to drain
+            self.process.stdin.write(req)
+            await self.process.stdin.drain()
 
     async def _send(self, need_resp: bool, **kwargs):
         if not self.clangd_started.is_set():
@@ -158,9 +355,19 @@ class ClangdClient:
         # make request body
         request = {'jsonrpc': '2.0', **kwargs}
 
+        if need_resp and 'method' in request:
+            self.inflight[request['id']] = request
+
         # put request to sending queue
         await self.send_queue.put((request, need_resp))
 
+    async def send_encoded(self, messages: list[bytes]):
+        if not self.clangd_started.is_set():
+            raise RuntimeError('analyzer is down, please call start_analyzer first')
+
+        # notifications framed by encode_message, nothing waits for them
+        await self.send_queue.put((messages, False))
+
     def get_id(self):
         self.id = self.id + 1
 
@@ -169,162 +376,1071 @@ class ClangdClient:
 
         return self.id
 
-    async def start(self, workspace_path: str = ''):
-        if '' == workspace_path:
-            raise RuntimeError('workspace_path cannot be a empty path')
-
-        # if process started
-        if None != self.process:
-            # and workspace changed
-            if workspace_path != self.workspace_path:
-                self.logger.info('restart server')
-                # restart server
-                await self.stop()
-            # workspace dod not change
-            else:
-                return
-
-        # process cwd
+    async def start(self, workspace_path: str, init_param: dict, *clangd_args, cdb_path: str = None):
+        # kept for restarting after a crash
         self.workspace_path = workspace_path
-        self.logger.info(f'os cwd switch to {workspace_path}')
-        os.chdir(self.workspace_path)
+        self.init_param = init_param
+        self.clangd_args = clangd_args
+        self.cdb_path = cdb_path
 
         # launch clangd process
-        self.process, cdb_file, clangd_path = clangd_utils.create_clangd_process(self.workspace_path, '--log=verbose', '--background-index')
+        self.process, cdb_file, clangd_path = await clangd_utils.create_clangd_process(workspace_path, *clangd_args, cdb_path=cdb_path)
         self.logger.info(f'find clangd: {clangd_path}')
 
         # set clangd start flag
         self.clangd_started.set()
 
         # start running recive task
-        self.recive_task = asyncio.create_task(self.__recive_task(), name='recive_task')
-        self.send_task = asyncio.create_task(self.__send_task(), name='send_task')
-
-        self.recive_task.add_done_callback(self.__done_cb)
-        self.send_task.add_done_callback(self.__done_cb)
-
-        # load init param
-        with open(os.path.join(self.script_path, 'init_param.json'), encoding='utf-8') as f:
-            param = json.loads(await asyncio.to_thread(f.read))
+        self.__start_tasks()
 
         # perform initialize sequence
-        await self.send_request('initialize', param)
+        await self.send_request('initialize', init_param)
         await self.send_notification('initialized', {})
 
-        # find a random file from cdb
-        with open(cdb_file, encoding='utf-8') as f:
-            cdb = json.loads(await asyncio.to_thread(f.read))
+        return cdb_file
 
-        # send did open request to force clangd load cdb
-        await self.did_open(os.path.join(cdb[0]['directory'], cdb[0]['file']))
-        # wait for clangd index the project
-        await self.wait_for_background_index_down()
+    async def detach(self) -> asyncio.subprocess.Process:
+        # hand the initialized process over to another connection
+        await self.__stop_tasks()
 
-    async def stop(self):
-        self.logger.info('stop server')
+        process = self.process
+        self.process = None
+        self.clangd_started.clear()
+        return process
+
+    async def restart(self, standby: 'ClangdConnection' = None) -> dict[int, dict]:
+        await self.__stop_tasks()
+
+        # reap the dead process
+        if None == self.process.returncode:
+            self.process.kill()
+        await self.process.communicate()
+
+        self.framer = clangd_utils.MessageFramer()
+        self.index_done.clear()
+        self.index_percentage = 0
+        self.index_message = ''
+
+        if None != standby:
+            self.process = await standby.detach()
+        else:
+            self.process, _, _ = await clangd_utils.create_clangd_process(
+                self.workspace_path, *self.clangd_args, cdb_path=self.cdb_path)
+
+        # queued messages were meant for the dead process, requests are resent
+        # once the documents are reopened by the client
+        inflight = dict(self.inflight)
+        self.send_queue = asyncio.Queue()
+        self.__start_tasks()
+
+        if None == standby:
+            await self.send_request('initialize', self.init_param)
+            await self.send_notification('initialized', {})
+
+        return inflight
+
+    def resend(self, inflight: dict[int, dict]):
+        for request_id, request in inflight.items():
+            # caller is gone
+            if request_id not in self.pending_requests:
+                continue
 
-        self.recive_task.cancel()
-        self.send_task.cancel()
+            self.send_queue.put_nowait((request, True))
 
-        self.process.terminate()
+    async def stop(self):
+        self.stopping = True
+        await self.__stop_tasks()
+
+        # clangd might have exited already
+        if None == self.process.returncode:
+            self.process.terminate()
+        # drain remaining output, otherwise the pipes never reach eof
+        await self.process.communicate()
         self.process = None
-        self.workspace_path = ''
-        self.opened_files.clear()
+        self.framer = clangd_utils.MessageFramer()
+
+        self.fail_pending(RuntimeError('analyzer stopped'))
 
         # clear queues
         self.send_queue = asyncio.Queue()
-        self.pending_queue.clear()
-        self.recived_queue = asyncio.Queue()
 
         # clear flags
         self.clangd_started.clear()
+        self.index_done.clear()
+        self.index_percentage = 0
+        self.index_message = ''
 
-    async def send_request(self, method: str, params: dict):
-        # send request with id
-        await self._send(True, method=method, params=params, id=self.get_id())
+    async def send_request(self, method: str, params: dict, timeout: float = None):
+        request_id = self.get_id()
 
-        # wait for response
-        return await self.recived_queue.get()
+        # register a future before sending, the response might arrive at any time
+        future = asyncio.get_running_loop().create_future()
+        self.pending_requests[request_id] = future
+
+        try:
+            # send request with id
+            await self._send(True, method=method, params=params, id=request_id)
+
+            # wait for the response with the same id
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except TimeoutError:
+                self.timed_out += 1
+                raise RuntimeError(f'{method} timed out after {timeout:.1f}s')
+        finally:
+            self.pending_requests.pop(request_id, None)
+            self.inflight.pop(request_id, None)
+
+            # timed out or canceled by the caller, clangd can drop the work
+            if future.cancelled() and self.clangd_started.is_set() and not self.stopping:
+                self.send_queue.put_nowait(({
+                    'jsonrpc': '2.0',
+                    'method': '$/cancelRequest',
+                    'params': {'id': request_id},
+                }, False))
 
     async def send_notification(self, method: str, params: dict):
         # send request without id
         await self._send(False, method=method, params=params)
 
+    def update_index_progress(self, value: dict):
+        kind = value['kind']
+
+        if 'begin' == kind:
+            self.index_done.clear()
+            self.index_percentage = 0
+            self.index_message = value.get('message', '')
+        elif 'report' == kind:
+            self.index_percentage = int(value.get('percentage', self.index_percentage))
+            self.index_message = value.get('message', self.index_message)
+        elif 'end' == kind:
+            self.index_percentage = 100
+            self.index_message = value.get('message', '')
+            self.index_done.set()
+
+        self.logger.info(f'clangd {self.name} indexing: {self.index_percentage}/100')
+
+    def get_status(self) -> dict:
+        return {
+            'index_complete': self.index_done.is_set(),
+            'index_percentage': self.index_percentage,
+            'index_message': self.index_message,
+        }
+
+class ClangdClient:
+    def __init__(self, workspace_path: str = '', log_ring_size: int = 2000,
+                 cache_size: int = 512, cache_ttl: float = 300,
+                 max_opened_files: int = 32, max_memory_mb: int = 0,
+                 standby: bool = False, request_timeout: float = 60, watch: bool = True):
+        self.workspace_path = workspace_path
+        # one connection per shard, a single one when sharding is disabled
+        self.connections: list[ClangdConnection] = []
+        # top level directory of workspace -> shard number
+        self.shard_dirs: dict[str, int] = {}
+        self.symbol_store: SymbolStore = None
+        # searchable copy of all workspace symbols, refreshed from clangd once indexed
+        self.symbol_index: SymbolIndex = None
+        self.symbol_index_task: asyncio.Task = None
+        self.symbol_index_ready = False
+        self.cdb: CompileDatabase = None
+        # interned paths of every location reported in this workspace
+        self.files: FileTable = None
+        # results of find_definition and find_references
+        self.result_cache = ResultCache(cache_size, cache_ttl)
+        # full reference lists behind paged answers, keyed by cursor token
+        self.held_results = ResultCache(32, 600)
+        # whole program call graph, built on demand in background
+        self.program_graph: program_graph.ProgramGraph = None
+        self.program_graph_task: asyncio.Task = None
+        self.program_graph_progress = [0, 0]
+        # files changed since the call graph is built
+        self.program_graph_stale: set[str] = set()
+        # identical in-flight requests share one response
+        self.request_flight = SingleFlight(cancel_abandoned=True)
+        # opened documents in lru order, absolute path -> number of users
+        self.opened_files: OrderedDict[str, int] = OrderedDict()
+        # (file, connection) -> [version, text] clangd has for opened documents
+        self.documents: dict[tuple, list] = {}
+        self.max_opened_files = max_opened_files
+        # concurrent did_open of the same file send only one didOpen
+        self.open_flight = SingleFlight()
+        # (file, connection) -> future of did_open calls made in the same loop
+        # iteration, their files are read together and sent in one write
+        self.open_batch: dict[tuple, asyncio.Future] = {}
+        self.open_batch_task: asyncio.Task = None
+        # close documents when clangd uses more memory than this, 0 means no limit
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.memory_check_time = 0
+        # keep an initialized spare clangd for every connection, so a restart
+        # of the same workspace swaps it in instead of spawning a new one
+        self.standby = standby
+        # (workspace, cdb path, clangd args, name) of every connection
+        self.connection_keys: list[tuple] = []
+        self.standbys: dict[tuple, asyncio.Task] = {}
+        self.init_param: dict = None
+        # upper bound of every clangd request, tool deadlines might be shorter
+        self.request_timeout = request_timeout
+        # times of the latest clangd crashes, give up when they come too fast
+        self.crash_times = deque(maxlen=3)
+        # edits on disk are pushed to clangd instead of restarting it
+        self.watch = watch
+        self.watcher: FileWatcher = None
+        # files deleted while running, clangd still reports what it indexed in them
+        self.deleted_files: set[str] = set()
+        # changed files clangd is still catching up with, what it reports of
+        # them is not recorded in the symbol store until the next refresh
+        self.unsettled_files: set[str] = set()
+        # changed files whose symbols are not refreshed yet
+        self.stale_symbol_files: set[str] = set()
+        # files whose indexed symbols come from their documents, which list
+        # prototypes next to the definitions
+        self.document_symbol_files: set[str] = set()
+        # files modified before this are indexed by clangd at start
+        self.start_time = 0
+        # cleared while file changes are pushed to clangd
+        self.changes_applied = asyncio.Event()
+        self.changes_applied.set()
+        self.change_lock = asyncio.Lock()
+        # path -> (mtime, size) of the latest change pushed to clangd, the same
+        # change might be reported by the watcher and by the git diff
+        self.applied_stamps: dict[str, tuple[int, int]] = {}
+        # files clangd has parsed as opened documents, what it got from them
+        # outranks its background index even after they are closed
+        self.parsed_files: set[str] = set()
+        # edited closed files waiting for clangd to parse them, in order
+        self.reparse_queue: dict[str, None] = {}
+        self.reparse_task: asyncio.Task = None
+        # files whose compile command is pushed to clangd by reindex
+        self.cdb_overlay: set[str] = set()
+        # checked out commit, a branch switch only pushes the files it changed
+        self.git_head: GitHead = None
+        self.watch_task: asyncio.Task = None
+        self.script_path = os.path.abspath(os.path.dirname(sys.argv[0]))
+
+        # latest clangd log lines, read from stderr
+        self.clangd_log = deque(maxlen=log_ring_size)
+
+        self.logger = get_logger(self.script_path)
+
+    async def start(self, workspace_path: str = '', shards: int = 1):
+        if '' == workspace_path:
+            raise RuntimeError('workspace_path cannot be a empty path')
+
+        # if process started
+        if self.connections:
+            # a clangd that could not be recovered stays down until restarted
+            down = [connection for connection in self.connections
+                    if not connection.clangd_started.is_set() and not connection.recovering]
+            # and workspace or shard count changed
+            if os.path.abspath(workspace_path) != self.workspace_path or shards != self.shards or down:
+                self.logger.info('restart server')
+                # restart server
+                await self.stop()
+            # workspace dod not change
+            else:
+                return
+
+        # several clients live in one process, so relative paths are resolved
+        # against the workspace instead of switching the process cwd
+        self.workspace_path = os.path.abspath(workspace_path)
+        self.shards = shards
+        self.files = FileTable(self.workspace_path)
+        self.start_time = time.time_ns()
+
+        # symbols recorded by previous sessions can be used right away
+        self.symbol_store = SymbolStore(os.path.join(clangd_utils.get_cache_dir(self.workspace_path), 'symbols.db'))
+
+        cdb_file = clangd_utils.search_cdb(self.workspace_path)
+        if None == cdb_file:
+            raise RuntimeError('no compile_commands.json found')
+
+        # cdb is read lazily, only the first entry is needed without sharding
+        self.cdb = CompileDatabase(os.path.join(self.workspace_path, cdb_file))
+
+        if shards > 1:
+            cdb_paths, prime_files = await asyncio.to_thread(self.make_shards, shards)
+        else:
+            entry = self.cdb.first_entry()
+            cdb_paths = [os.path.dirname(os.path.join(self.workspace_path, cdb_file))]
+            prime_files = [os.path.join(entry['directory'], entry['file'])]
+
+        # load init param, it does not depend on the workspace
+        if None == self.init_param:
+            with open(os.path.join(self.script_path, 'init_param.json'), encoding='utf-8') as f:
+                self.init_param = json.loads(await asyncio.to_thread(f.read))
+
+        clangd_args = ('--log=verbose', '--background-index')
+        # shards share the cpu cores for background index
+        if len(cdb_paths) > 1:
+            clangd_args += (f'-j={max(1, (os.cpu_count() or 1) // len(cdb_paths))}',)
+
+        self.connection_keys = [
+            (self.workspace_path, cdb_path, clangd_args, f'shard{i}' if len(cdb_paths) > 1 else '')
+            for i, cdb_path in enumerate(cdb_paths)
+        ]
+
+        # standbys of another workspace or shard layout are of no use
+        await self.stop_standbys([key for key in self.standbys if key not in self.connection_keys])
+
+        self.connections = list(await asyncio.gather(*[
+            self.take_connection(key) for key in self.connection_keys
+        ]))
+
+        # send did open request to force clangd load cdb, index runs in background
+        await self.did_open_many(prime_files)
+
+        # file to entry index of cdb is built in background as well
+        self.cdb_index_task = background_task(asyncio.to_thread(self.cdb.build_index), 'cdb_index_task')
+
+        self.symbol_index = SymbolIndex(self.workspace_path)
+        self.symbol_index_ready = False
+        self.symbol_index_task = background_task(self.__build_symbol_index(), 'symbol_index_task')
+
+        self.prepare_standbys()
+
+        # the watcher walks the whole tree, the analyzer is usable before it is done
+        self.watch_task = background_task(self.__start_watching(), 'watch_task')
+
+    async def __start_watching(self):
+        try:
+            self.git_head = await GitHead.open(self.workspace_path)
+
+            if self.watch:
+                watcher = FileWatcher(self.workspace_path, self.on_files_changed, self.logger, triggers=
+                                      self.git_head.trigger_files() if None != self.git_head else None)
+                await watcher.start()
+                self.watcher = watcher
+                # changes clear the cache from now on, results cached before
+                # might miss some
+                self.result_cache.clear()
+                self.result_cache.check_files = False
+        except Exception as e:
+            self.logger.warning(f'start watching failed: {e}')
+
+    async def spawn_connection(self, key: tuple) -> ClangdConnection:
+        workspace_path, cdb_path, clangd_args, name = key
+
+        connection = ClangdConnection(self.logger, self.clangd_log, name)
+        connection.key = key
+        await connection.start(workspace_path, self.init_param, *clangd_args, cdb_path=cdb_path)
+        return connection
+
+    async def take_standby(self, key: tuple) -> Union[ClangdConnection, None]:
+        task = self.standbys.pop(key, None)
+
+        if None == task:
+            return None
+
+        try:
+            connection = await task
+            # standby might have died while waiting
+            if None == connection.process.returncode:
+                self.logger.info(f'swap in standby clangd {key[3]}')
+                return connection
+            await connection.stop()
+        except Exception as e:
+            self.logger.warning(f'standby clangd {key[3]} is not usable: {e}')
+
+        return None
+
+    async def take_connection(self, key: tuple) -> ClangdConnection:
+        connection = await self.take_standby(key)
+
+        if None == connection:
+            connection = await self.spawn_connection(key)
+
+        connection.on_exit = self.recover
+        return connection
+
+    async def recover(self, connection: ClangdConnection):
+        now = time.monotonic()
+        self.crash_times.append(now)
+
+        try:
+            # crash loop, restarting does not help
+            if self.crash_times.maxlen == len(self.crash_times) and now - self.crash_times[0] < 60:
+                raise RuntimeError(f'clangd crashed {len(self.crash_times)} times in a minute')
+
+            self.logger.warning(f'clangd {connection.name} exited unexpectedly, restart it')
+            inflight = await connection.restart(await self.take_standby(connection.key))
+
+            # reopen documents without touching their users
+            keys = [key for key in self.opened_files if key[1] is connection]
+            for (file, _), result in zip(keys, await self.__send_did_open(keys)):
+                if None != result:
+                    self.logger.warning(f'reopen {file} failed: {result}')
+
+            connection.resend(inflight)
+            self.logger.info(f'clangd {connection.name} recovered, {len(inflight)} requests resent')
+        except Exception as e:
+            self.logger.critical(f'recover clangd {connection.name} failed: {e}')
+            connection.clangd_started.clear()
+            connection.fail_pending(RuntimeError(f'clangd exited unexpectedly: {e}'))
+            return
+        finally:
+            connection.recovering = False
+
+        self.prepare_standbys()
+
+    def prepare_standbys(self):
+        if not self.standby:
+            return
+
+        # standby only initializes, no document is opened so it does not
+        # load the cdb or run background index beside the active one
+        for key in self.connection_keys:
+            if key not in self.standbys:
+                self.standbys[key] = background_task(self.spawn_connection(key), 'standby_task')
+
+    async def stop_standbys(self, keys: list[tuple] = None):
+        if None == keys:
+            keys = list(self.standbys)
+
+        tasks = [self.standbys.pop(key) for key in keys]
+        # a half spawned process is not canceled, it is stopped once it is up
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, ClangdConnection):
+                try:
+                    await result.stop()
+                except Exception as e:
+                    self.logger.warning(f'stop standby clangd failed: {e}')
+
+    def make_shards(self, count: int) -> tuple[list[str], list[str]]:
+        self.cdb.build_index()
+
+        # group entries by top level directory
+        groups: dict[str, list[int]] = {}
+        for index, file in enumerate(self.cdb.files):
+            groups.setdefault(clangd_utils.top_level_dir(file, self.workspace_path), []).append(index)
+
+        count = max(1, min(count, len(groups)))
+        shard_entries: list[list[int]] = [[] for _ in range(count)]
+
+        # biggest group goes to the least loaded shard
+        for top, indexes in sorted(groups.items(), key=lambda item: len(item[1]), reverse=True):
+            shard = min(range(count), key=lambda i: len(shard_entries[i]))
+            shard_entries[shard].extend(indexes)
+            self.shard_dirs[top] = shard
+
+        cdb_paths, prime_files = [], []
+        for shard, indexes in enumerate(shard_entries):
+            cdb_path = os.path.join(clangd_utils.get_cache_dir(self.workspace_path), 'shards', str(shard))
+            os.makedirs(cdb_path, exist_ok=True)
+
+            indexes.sort()
+            self.cdb.write_subset(indexes, os.path.join(cdb_path, clangd_utils.CDB_NAME))
+
+            cdb_paths.append(cdb_path)
+            prime_files.append(self.cdb.files[indexes[0]])
+
+        return cdb_paths, prime_files
+
+    async def stop(self, keep_standby: bool = False):
+        self.logger.info('stop server')
+
+        # canceling would leave the inotify descriptor of a half started watcher open
+        if None != self.watch_task:
+            await self.watch_task
+        self.watch_task = None
+        if None != self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        self.result_cache.check_files = True
+        self.git_head = None
+        if None != self.reparse_task:
+            self.reparse_task.cancel()
+        self.reparse_task = None
+        self.reparse_queue.clear()
+        self.applied_stamps.clear()
+        self.parsed_files.clear()
+        self.cdb_overlay.clear()
+        # crashes of a previous session do not count against a restarted one
+        self.crash_times.clear()
+        if None != self.open_batch_task:
+            self.open_batch_task.cancel()
+        self.open_batch_task = None
+        for future in self.open_batch.values():
+            if not future.done():
+                future.set_exception(RuntimeError('analyzer stopped'))
+        self.open_batch.clear()
+
+        await asyncio.gather(*[connection.stop() for connection in self.connections])
+        self.connections = []
+        if not keep_standby:
+            await self.stop_standbys()
+        self.shard_dirs.clear()
+
+        # start might have failed half way
+        if None != self.symbol_store:
+            self.symbol_store.close()
+            self.symbol_store = None
+        if None != self.cdb:
+            self.cdb.close()
+            self.cdb = None
+        self.result_cache.clear()
+        self.held_results.clear()
+        if None != self.symbol_index_task:
+            self.symbol_index_task.cancel()
+        self.symbol_index_task = None
+        self.symbol_index = None
+        if None != self.program_graph_task:
+            self.program_graph_task.cancel()
+        self.program_graph_task = None
+        self.program_graph = None
+        self.program_graph_stale.clear()
+        self.files = None
+        self.workspace_path = ''
+        self.opened_files.clear()
+        self.documents.clear()
+        self.deleted_files.clear()
+        self.unsettled_files.clear()
+        self.stale_symbol_files.clear()
+        self.document_symbol_files.clear()
+
+    def resolve(self, fn: str) -> str:
+        return os.path.normpath(os.path.join(self.workspace_path, fn))
+
+    def connection_for(self, fn: str) -> ClangdConnection:
+        if not self.connections:
+            raise RuntimeError('analyzer is down, please call start_analyzer first')
+
+        if 1 == len(self.connections):
+            return self.connections[0]
+
+        # file belongs to the shard of its top level directory
+        top = clangd_utils.top_level_dir(fn, self.workspace_path)
+        return self.connections[self.shard_dirs.get(top, 0)]
+
+    async def send_request(self, method: str, params: dict, connection: ClangdConnection = None, timeout: float = None):
+        if None == connection:
+            connection = self.connection_for(self.workspace_path)
+
+        # timeout overrides the request timeout, 0 waits as long as clangd takes
+        timeout = (self.request_timeout if None == timeout else timeout) or None
+        remaining = remaining_time()
+        if None != remaining:
+            timeout = remaining if None == timeout else min(timeout, remaining)
+
+        # the shared request lives as long as its most patient waiter, it is
+        # canceled in clangd once every waiter has given up
+        key = (connection.name, method, json.dumps(params, sort_keys=True))
+        try:
+            return await self.request_flight.do(
+                key, lambda: connection.send_request(method, params), timeout)
+        except TimeoutError:
+            connection.timed_out += 1
+            raise RuntimeError(f'{method} timed out after {timeout:.1f}s')
+
+    async def send_notification(self, method: str, params: dict, connection: ClangdConnection = None):
+        if None == connection:
+            connection = self.connection_for(self.workspace_path)
+
+        await connection.send_notification(method, params)
+
+    def index_complete(self) -> bool:
+        return bool(self.connections) and all(connection.index_done.is_set() for connection in self.connections)
+
     async def wait_for_background_index_down(self):
-        request = await self.recived_queue.get()
-
-        if request['method'] != 'window/workDoneProgress/create':
-            self.logger.info(f'unexpected response : {request['method']}')
-            raise RuntimeError('recived error request')
-
-        # send response to clangd
-        await self._send(False, id=request['id'], result=None)
-
-        # loop handle $/progress notification until it is done
-        done_flag = False
-        percentage = 0
-
-        while False == done_flag:
-            progress = await self.recived_queue.get()
-            # self.logger.info(f'progress: {json.dumps(progress, indent=4)}')
-            kind = progress['params']['value']['kind']
-
-            if 'end' == kind:
-                done_flag = True
-                percentage = 100
-            elif 'report' == kind:
-                percentage = int(progress['params']['value']['percentage'])
-            
-            self.logger.info(f'clangd indexing: {percentage}/100')
-            
-
-    async def did_open(self, fn: str):
-        file = os.path.abspath(fn)
-
-        # if this file already opened
-        if fn in self.opened_files:
-            # skip it
-            return file
-
-        with open(file, encoding='utf-8') as f:
-            await self.send_notification('textDocument/didOpen', {
-                'textDocument': {
-                    'uri': clangd_utils.fn_to_uri(file),
-                    'languageId': 'c',
-                    'version': 1,
-                    'text': await asyncio.to_thread(f.read)
-                }
-            })
+        await asyncio.gather(*[connection.index_done.wait() for connection in self.connections])
+
+    def get_status(self) -> dict:
+        status = {
+            'started': bool(self.connections),
+            'workspace_path': self.workspace_path,
+            'index_complete': self.index_complete(),
+            'index_percentage': 0,
+            'index_message': '',
+        }
+
+        if 1 == len(self.connections):
+            status.update(self.connections[0].get_status())
+        elif self.connections:
+            status['index_percentage'] = sum(connection.index_percentage for connection in self.connections) // len(self.connections)
+            status['shards'] = [connection.get_status() for connection in self.connections]
+
+        status.update({
+            'result_cache': self.result_cache.get_stats(),
+            'coalesced_requests': self.request_flight.shared,
+            'timed_out_requests': sum(connection.timed_out for connection in self.connections),
+            'opened_files': len(self.opened_files),
+            'symbol_index': {
+                'symbols': len(self.symbol_index) if None != self.symbol_index else 0,
+                'complete': self.symbol_index_ready,
+            },
+            'call_graph': self.program_graph_status(),
+            'watcher': self.watcher.get_status() if None != self.watcher else {'mode': 'off'},
+            'git_head': self.git_head.commit[:12] if None != self.git_head else '',
+            'reparse_pending': len(self.reparse_queue),
+            'standby': self.standby,
+            'standby_ready': sum(task.done() and not task.cancelled() and None == task.exception()
+                                 for task in self.standbys.values()),
+        })
 
-        # record opened file
-        self.opened_files.add(fn)
+        return status
+
+    async def did_open(self, fn: str, connection: ClangdConnection = None, pin: bool = False):
+        file = self.resolve(fn)
+
+        # file is opened by the shard it belongs to by default
+        if None == connection:
+            connection = self.connection_for(file)
+
+        key = (file, connection)
+        newly_opened = False
+
+        # a trim of another task might close the file again before this one
+        # resumes, open it until it is there
+        while key not in self.opened_files:
+            await self.open_flight.do(key, lambda: self.__did_open(file, connection))
+            newly_opened = True
+
+        # mark it as recently used, a pinned file is not closed by trims
+        self.opened_files.move_to_end(key)
+        if pin:
+            self.opened_files[key] += 1
+
+        if newly_opened:
+            await self.trim_opened_files(keep={key})
 
         return file
 
-    async def did_close(self, fn: str):
-        file = os.path.abspath(fn)
+    async def did_open_many(self, fns: list[str], connection: ClangdConnection = None) -> list[str]:
+        keys = []
+        for fn in fns:
+            file = self.resolve(fn)
+            keys.append((file, connection or self.connection_for(file)))
+        keys = list(dict.fromkeys(keys))
+
+        for key in keys:
+            if key in self.opened_files:
+                self.opened_files.move_to_end(key)
+
+        # all of them join the same batch
+        results = await asyncio.gather(*[self.open_flight.do(key, lambda key=key: self.__did_open(*key))
+                                         for key in keys if key not in self.opened_files], return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                self.logger.warning(f'open file failed: {result}')
+
+        await self.trim_opened_files(keep=set(keys))
+
+        # files that could not be read are left out
+        return [file for file, connection in keys if (file, connection) in self.opened_files]
+
+    async def __did_open(self, file: str, connection: ClangdConnection):
+        future = asyncio.get_running_loop().create_future()
+        self.open_batch[(file, connection)] = future
+
+        if None == self.open_batch_task:
+            self.open_batch_task = background_task(self.__open_batch(), 'open_batch_task')
+
+        await future
+
+        # record opened file
+        self.opened_files[(file, connection)] = 0
+
+    async def __open_batch(self):
+        # let did_open calls of the same gather join
+        await asyncio.sleep(0)
+
+        batch, self.open_batch, self.open_batch_task = self.open_batch, {}, None
+        results = [RuntimeError('analyzer stopped')] * len(batch)
+
+        try:
+            results = await self.__send_did_open(list(batch))
+        except Exception as e:
+            results = [e] * len(batch)
+        finally:
+            for future, result in zip(batch.values(), results):
+                if future.done():
+                    continue
+                if None == result:
+                    future.set_result(None)
+                else:
+                    future.set_exception(result)
+
+    async def __send_did_open(self, keys: list[tuple]) -> list[Union[Exception, None]]:
+        # files are read and encoded in worker threads at once, didOpen of all
+        # of them goes to clangd in one write per connection
+        documents = await asyncio.gather(*[asyncio.to_thread(encode_did_open, file) for file, _ in keys],
+                                         return_exceptions=True)
+
+        messages: dict[ClangdConnection, list[bytes]] = {}
+        for (_, connection), document in zip(keys, documents):
+            if not isinstance(document, BaseException):
+                messages.setdefault(connection, []).append(document[1])
+
+        for connection, encoded in messages.items():
+            await connection.send_encoded(encoded)
+
+        results = []
+        for (file, connection), document in zip(keys, documents):
+            if isinstance(document, BaseException):
+                results.append(document)
+                continue
+
+            # kept to send later edits as incremental changes
+            self.documents[(file, connection)] = [1, document[0]]
+            self.parsed_files.add(file)
+            results.append(None)
+
+        return results
+
+    async def did_change(self, file: str, connection: ClangdConnection):
+        document = self.documents.get((file, connection), None)
+        if None == document:
+            return
+
+        try:
+            with open(file, encoding='utf-8') as f:
+                text = await asyncio.to_thread(f.read)
+        except OSError:
+            await self.did_close(file, connection)
+            return
+
+        edit = clangd_utils.text_edit(document[1], text)
+        if None == edit:
+            return
+
+        document[0] += 1
+        document[1] = text
+
+        await self.send_notification('textDocument/didChange', {
+            'textDocument': {
+                'uri': clangd_utils.fn_to_uri(file),
+                'version': document[0],
+            },
+            'contentChanges': [edit],
+        }, connection)
+
+    async def did_close(self, fn: str, connection: ClangdConnection = None):
+        file = self.resolve(fn)
+
+        if None == connection:
+            connection = self.connection_for(file)
+
+        if (file, connection) not in self.opened_files:
+            return
+
+        # forget it first, a later did_open should send didOpen again
+        del self.opened_files[(file, connection)]
+        self.documents.pop((file, connection), None)
 
         await self.send_notification('textDocument/didClose', {
             'textDocument': {
                 'uri': clangd_utils.fn_to_uri(file)
             }
-        })
+        }, connection)
 
-        self.opened_files.remove(fn)
+    @asynccontextmanager
+    async def opened(self, fn: str, connection: ClangdConnection = None):
+        if None == connection:
+            connection = self.connection_for(self.resolve(fn))
+
+        # file in use should not be closed
+        file = await self.did_open(fn, connection, pin=True)
+        key = (file, connection)
+
+        try:
+            yield file
+        finally:
+            if key in self.opened_files:
+                self.opened_files[key] -= 1
+
+        # files pinned by others might be left open, close them after use
+        if len(self.opened_files) > self.max_opened_files:
+            await self.trim_opened_files()
+
+    async def trim_opened_files(self, keep: set[tuple] = frozenset()):
+        # least recently used files that are not in use
+        idle = [key for key, users in self.opened_files.items() if 0 == users and key not in keep]
+
+        close_count = max(0, len(self.opened_files) - self.max_opened_files)
+
+        # ask clangd for memory usage at most once per interval
+        if self.max_memory > 0 and time.monotonic() - self.memory_check_time > 10:
+            self.memory_check_time = time.monotonic()
+            usages = await asyncio.gather(*[
+                self.send_request('$/memoryUsage', None, connection) for connection in self.connections
+            ])
+            usage = sum(usage.get('result', {}).get('_total', 0) for usage in usages)
+
+            # close half of the idle files, each one keeps an ast and a preamble
+            if usage > self.max_memory:
+                self.logger.info(f'clangd memory usage: {usage}')
+                close_count = max(close_count, (len(idle) + 1) // 2)
+
+        if 0 == close_count:
+            return
+
+        for file, connection in idle[:close_count]:
+            self.logger.info(f'close file: {file}')
+            await self.did_close(file, connection)
+
+    async def on_files_changed(self, changes: Union[dict[str, int], None]):
+        if not self.connections:
+            return
+
+        # lookups wait until clangd has seen the edits
+        async with self.change_lock:
+            self.changes_applied.clear()
+            try:
+                applied = await self.__sync_changes(changes)
+            finally:
+                self.changes_applied.set()
+
+        if applied:
+            self.refresh_symbol_index()
+
+    async def __sync_changes(self, changes: Union[dict[str, int], None]) -> bool:
+        # events were lost, any file might have changed
+        if None == changes:
+            self.logger.warning('file events overflowed, resync opened documents')
+            changes = {file: CHANGED for file, _ in self.documents}
+
+        triggers = set(self.git_head.trigger_files()) if None != self.git_head else set()
+        changes = {path: change for path, change in changes.items() if path not in triggers}
+
+        # a moved HEAD tells exactly which files differ, events of a big
+        # checkout might be lost or still on their way
+        changes.update(await self.head_changes())
+
+        changes = await asyncio.to_thread(self.__unapplied, changes)
+        if not changes:
+            return False
+
+        self.logger.info(f'{len(changes)} files changed')
+        await self.__apply_changes(changes)
+        return True
+
+    async def head_changes(self) -> dict[str, int]:
+        if None == self.git_head or not self.git_head.moved():
+            return {}
+
+        try:
+            changes = await self.git_head.changes()
+        except RuntimeError as e:
+            self.logger.warning(f'diff of HEAD failed: {e}')
+            return {}
+
+        if changes:
+            self.logger.info(f'HEAD moved to {self.git_head.commit[:12]}, {len(changes)} files differ')
+
+        return changes
+
+    def __unapplied(self, changes: dict[str, int]) -> dict[str, int]:
+        unapplied = {}
+
+        for path, change in changes.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # the file on disk decides, whatever the event said
+                if path not in self.deleted_files:
+                    unapplied[path] = DELETED
+                continue
+
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if self.applied_stamps.get(path, None) != stamp:
+                self.applied_stamps[path] = stamp
+                unapplied[path] = CHANGED if DELETED == change else change
+
+        return unapplied
+
+    async def __apply_changes(self, changes: dict[str, int]):
+        paths = list(changes)
+
+        # an edit might add references or definitions to any answer, not only
+        # to the ones built from the edited files, the symbol store checks
+        # content hashes itself
+        self.result_cache.clear()
+        self.program_graph_stale.update(paths)
+        await asyncio.to_thread(self.symbol_index.remove_files, paths)
+
+        for path, change in changes.items():
+            if DELETED == change:
+                self.deleted_files.add(path)
+                self.applied_stamps.pop(path, None)
+                self.reparse_queue.pop(path, None)
+                self.stale_symbol_files.discard(path)
+            else:
+                self.deleted_files.discard(path)
+                self.unsettled_files.add(path)
+                if clangd_utils.CDB_NAME != os.path.basename(path) and watcher.is_watched(path):
+                    self.stale_symbol_files.add(path)
+
+        # opened documents are owned by the client, clangd only sees edits
+        # pushed to it, changes are sent as ranges instead of the whole text
+        synced, changed = set(), []
+        for file, connection in list(self.documents):
+            if file not in changes:
+                continue
+
+            synced.add(file)
+            if DELETED == changes[file]:
+                await self.did_close(file, connection)
+            else:
+                await self.did_change(file, connection)
+                changed.append((file, connection))
+
+        # a document request is answered from the new ast, by then the index
+        # of the document is updated as well, and the document can be closed
+        await asyncio.gather(*[self.send_request('textDocument/documentSymbol', {
+            'textDocument': {'uri': clangd_utils.fn_to_uri(file)}
+        }, connection) for file, connection in changed], return_exceptions=True)
+
+        # clangd reloads compile commands and its config on these
+        closed = [path for path in paths if path not in synced]
+        if closed:
+            for connection in self.connections:
+                await self.send_notification('workspace/didChangeWatchedFiles', {
+                    'changes': [{'uri': clangd_utils.fn_to_uri(path), 'type': changes[path]} for path in closed],
+                }, connection)
+
+        if clangd_utils.CDB_NAME in set(os.path.basename(path) for path in paths):
+            await self.reload_cdb()
+
+        # files opened before and files without compile command, mostly
+        # headers, are parsed again, the others are reindexed in background
+        sources = [path for path in closed if DELETED != changes[path] and
+                   clangd_utils.CDB_NAME != os.path.basename(path) and watcher.is_watched(path)]
+        reparse = [path for path in sources if path in self.parsed_files]
+        reparse += await self.reindex([path for path in sources if path not in self.parsed_files])
+
+        await asyncio.gather(*[self.reparse_file(path) for path in reparse[:REFRESH_LIMIT]])
+        if len(reparse) > REFRESH_LIMIT:
+            self.queue_reparse(reparse[REFRESH_LIMIT:])
+
+    async def reindex(self, paths: list[str]) -> list[str]:
+        # background index does not read changed files on its own, it does
+        # reindex files whose compile command is changed, setting the same
+        # command again reindexes exactly these files without opening them
+        await self.cdb_index_task
+
+        commands: dict[ClangdConnection, dict] = {}
+        uncompiled = []
+        for path in paths:
+            entry = self.cdb.entry_for(path)
+            if None == entry:
+                uncompiled.append(path)
+                continue
+
+            commands.setdefault(self.connection_for(path), {})[path] = {
+                'workingDirectory': entry['directory'],
+                'compilationCommand': command_arguments(entry),
+            }
+            self.cdb_overlay.add(path)
+
+        for connection, files in commands.items():
+            await self.send_notification('workspace/didChangeConfiguration', {
+                'settings': {'compilationDatabaseChanges': files},
+            }, connection)
+
+        return uncompiled
+
+    def queue_reparse(self, paths: list[str]):
+        for path in paths:
+            self.reparse_queue[path] = None
+
+        if None == self.reparse_task or self.reparse_task.done():
+            self.reparse_task = background_task(self.__reparse(), 'reparse_task')
+
+    async def reparse_file(self, path: str):
+        try:
+            # opened documents are trimmed as usual, clangd keeps their index
+            async with self.opened(path) as file:
+                await self.send_request('textDocument/documentSymbol', {
+                    'textDocument': {'uri': clangd_utils.fn_to_uri(file)}
+                }, self.connection_for(file))
+        except Exception as e:
+            self.logger.warning(f'reparse {path} failed: {e}')
+
+    async def __reparse(self, concurrency: int = 4):
+        self.logger.info(f'reparse {len(self.reparse_queue)} files in background')
+
+        while self.reparse_queue:
+            paths = list(itertools.islice(self.reparse_queue, concurrency))
+            for path in paths:
+                del self.reparse_queue[path]
+
+            await asyncio.gather(*[self.reparse_file(path) for path in paths])
+
+    def drop_deleted(self, response: dict, field: str = None) -> dict:
+        if not self.deleted_files or not response.get('result', None):
+            return response
+
+        return {**response, 'result': [item for item in response['result'] if clangd_utils.uri_to_fn(
+            (item[field] if field else item)['uri']) not in self.deleted_files]}
+
+    async def reload_cdb(self):
+        # sharded cdbs are subsets written at start, they need a restart
+        if self.shards > 1 or not os.path.exists(self.cdb.cdb_file):
+            self.logger.warning('compile_commands.json changed, restart the analyzer to apply it')
+            return
+
+        await self.cdb_index_task
+        self.cdb.close()
+        self.cdb = CompileDatabase(self.cdb.cdb_file)
+        self.cdb_index_task = background_task(asyncio.to_thread(self.cdb.build_index), 'cdb_index_task')
+
+        # commands pushed by reindex outrank compile_commands.json in clangd
+        # and lsp cannot drop them, they are replaced by the new commands
+        overlay, self.cdb_overlay = self.cdb_overlay, set()
+        dropped = await self.reindex(sorted(overlay))
+        if dropped:
+            self.logger.warning(f'{len(dropped)} files left compile_commands.json, '
+                                'clangd keeps their previous command until the analyzer is restarted')
+
+    def refresh_symbol_index(self):
+        # a running build or refresh picks up later changes as well
+        if None != self.symbol_index_task and not self.symbol_index_task.done():
+            return
+
+        self.symbol_index_task = background_task(self.__refresh_symbol_index(), 'symbol_index_task')
+
+    async def get_compile_command(self, fn: str) -> dict:
+        # index might be still building
+        await self.cdb_index_task
+
+        entry = self.cdb.entry_for(self.resolve(fn))
+        if None == entry:
+            raise RuntimeError(f'no compile command found for {fn}')
+
+        return entry
+
+    def get_clangd_log(self, lines: int) -> list[str]:
+        if lines <= 0:
+            return []
+
+        return list(self.clangd_log)[-lines:]
+
+    async def workspace_symbol(self, symbol: str, limit: int = None, timeout: float = None):
+        params = {'query': symbol}
+        # clangd extension, 0 means no limit
+        if None != limit:
+            params['limit'] = limit
+
+        # every shard only knows symbols of its own part
+        responses = await asyncio.gather(*[self.send_request('workspace/symbol', params, connection, timeout)
+                                           for connection in self.connections])
+
+        if 1 == len(responses):
+            return responses[0]
+
+        # an unlimited query returns the whole index, merge it off the loop
+        return await asyncio.to_thread(merge_symbols, responses)
 
-    async def workspace_symbol(self, symbol: str):
-        return await self.send_request('workspace/symbol', {
-            'query': symbol
-        })
-    
     async def document_symbol(self, uri: str):
         return await self.send_request('textDocument/documentSymbol', {
             'textDocument': {
                 'uri': uri
             }
-        })
+        }, self.connection_for(clangd_utils.uri_to_fn(uri)))
+
+    async def document_references(self, uri: str, line: int, character: int, connection: ClangdConnection = None):
+        if None == connection:
+            connection = self.connection_for(clangd_utils.uri_to_fn(uri))
 
-    async def document_references(self, uri: str, line: int, character: int):
         reference = await self.send_request('textDocument/references', {
             'textDocument': {'uri': uri},
             'context': {'includeDeclaration': True},
@@ -332,7 +1448,7 @@ class ClangdClient:
                 'line': int(line),
                 'character': int(character)
             },
-        })
+        }, connection)
 
         clangd_utils.check_resault(reference)
         return reference
@@ -344,43 +1460,568 @@ class ClangdClient:
                 'line': int(line),
                 'character': int(character)
             },
-        })
+        }, self.connection_for(clangd_utils.uri_to_fn(uri)))
 
         clangd_utils.check_resault(definition)
         return definition
 
-    async def find_symbol_definition(self, symbol: str):
-        # find symbol location first
+    async def document_symbol_info(self, uri: str, line: int, character: int):
+        # clangd extension, the declaration and definition known to the file
+        return await self.send_request('textDocument/symbolInfo', {
+            'textDocument': {'uri': uri},
+            'position': {
+                'line': int(line),
+                'character': int(character)
+            },
+        }, self.connection_for(clangd_utils.uri_to_fn(uri)))
+
+    async def find_symbol_definition(self, symbol: str, symbol_filter: SymbolFilter = None) -> list[str]:
+        symbol_filter = symbol_filter or SymbolFilter()
+        cached = self.result_cache.get((symbol, 'definition', symbol_filter.key()))
+        if None != cached:
+            return cached
+
+        candidates, resolved = await self.locate_symbols(symbol, symbol_filter)
+
+        async def candidate_definition(symbol_loc: dict) -> list[dict]:
+            # location recorded in symbol store is the definition already
+            if resolved:
+                return [symbol_loc]
+
+            # open the file where the symbol is located
+            async with self.opened(clangd_utils.uri_to_fn(symbol_loc['uri'])):
+                # clangd goes from a definition to its declaration, so the
+                # location is checked against the definition of the symbol first
+                info = await self.document_symbol_info(symbol_loc['uri'], **symbol_loc['range']['start'])
+                for details in info.get('result', None) or []:
+                    if clangd_utils.location_contains(details.get('definitionRange', None), symbol_loc):
+                        return [details['definitionRange']]
+
+                # find symbol definition
+                definition = await self.document_definition(symbol_loc['uri'], **symbol_loc['range']['start'])
+
+            return definition['result']
+
+        # every candidate is resolved at once, same named statics all count
+        results = await asyncio.gather(*[candidate_definition(candidate['location']) for candidate in candidates],
+                                       return_exceptions=True)
+        if all(isinstance(result, BaseException) for result in results):
+            raise results[0]
+
+        definition = clangd_utils.merge_results(
+            [{'result': result} for result in results if not isinstance(result, BaseException)])
+
+        locations = LocationList.from_response(definition, self.files)
+        result = locations.to_list()
+
+        # result might be incomplete before the index is done
+        if self.index_complete():
+            self.result_cache.put((symbol, 'definition', symbol_filter.key()), result, locations.paths())
+
+        return result
+
+    async def find_symbol_references(self, symbol: str, symbol_filter: SymbolFilter = None) -> list[str]:
+        return (await self.symbol_references(symbol, symbol_filter)).to_list()
+
+    async def symbol_references(self, symbol: str, symbol_filter: SymbolFilter = None) -> LocationList:
+        symbol_filter = symbol_filter or SymbolFilter()
+        cached = self.result_cache.get((symbol, 'references', symbol_filter.key()))
+        if None != cached:
+            return cached
+
+        # find symbol locations first
+        candidates, _ = await self.locate_symbols(symbol, symbol_filter)
+
+        async def shard_references(symbol_loc: dict, connection: ClangdConnection):
+            # open the file where the symbol is located
+            async with self.opened(clangd_utils.uri_to_fn(symbol_loc['uri']), connection):
+                # find symbol references
+                return await self.document_references(symbol_loc['uri'], **symbol_loc['range']['start'], connection=connection)
+
+        # every shard only indexes references in its own part
+        jobs = [(candidate['location'], connection) for candidate in candidates for connection in self.connections]
+        responses = await asyncio.gather(*[shard_references(*job) for job in jobs], return_exceptions=True)
+
+        if all(isinstance(response, BaseException) for response in responses):
+            raise responses[0]
+
+        reference = self.drop_deleted(clangd_utils.merge_results(responses))
+
+        # a timed out shard leaves the others' references, answer with them
+        partial = False
+        for (_, connection), response in zip(jobs, responses):
+            if isinstance(response, BaseException):
+                partial = True
+                self.logger.warning(f'references of {symbol} from {connection.name} failed: {response}')
+
+        locations = LocationList.from_response(reference, self.files)
+
+        # result might be incomplete before the index is done
+        if self.index_complete() and not partial:
+            self.result_cache.put((symbol, 'references', symbol_filter.key()), locations, [
+                *[clangd_utils.uri_to_fn(candidate['location']['uri']) for candidate in candidates],
+                *locations.paths(),
+            ])
+
+        return locations
+
+    async def page_symbol_references(self, symbol: str, limit: int = 0, offset: int = 0,
+                                     cursor: str = '', group_by_file: bool = False,
+                                     symbol_filter: SymbolFilter = None) -> dict:
+        # cursor is token:offset, the token names a result held by the client
+        if cursor:
+            token, _, offset = cursor.rpartition(':')
+            held = self.held_results.get(token) if token and offset.isdigit() else None
+            if None == held:
+                raise RuntimeError('cursor expired or invalid, please call find_references again')
+            items, group_by_file = held
+            offset = int(offset)
+        elif not symbol:
+            raise RuntimeError('symbol_name is needed when no cursor is given')
+        else:
+            locations = await self.symbol_references(symbol, symbol_filter)
+            items = locations.group_by_file() if group_by_file else locations
+            token = uuid.uuid4().hex[:12]
+
+        offset = max(0, offset)
+        end = len(items) if limit <= 0 else offset + limit
+        page = {
+            # locations are turned into path:line only for the requested page
+            'result': items[offset:end] if group_by_file else items.to_list(offset, end),
+            'total': len(items),
+            'offset': offset,
+        }
+
+        # hold the rest for the following pages, clangd is not asked again
+        if end < len(items):
+            self.held_results.put(token, (items, group_by_file), [])
+            page['next_cursor'] = f'{token}:{end}'
+
+        return page
+
+    async def call_hierarchy(self, symbol: str, direction: str = 'incoming', depth: int = 2,
+                             max_nodes: int = 200, concurrency: int = 8) -> dict:
+        if direction not in call_graph.DIRECTIONS:
+            raise RuntimeError(f'direction should be one of {', '.join(call_graph.DIRECTIONS)}')
+
         symbol_loc = await self.locate_symbol(symbol)
-        # open the file where the symbol is located
-        await self.did_open(clangd_utils.uri_to_fn(symbol_loc['uri']))
+        fn = clangd_utils.uri_to_fn(symbol_loc['uri'])
 
-        # find symbol definition
-        definition = await self.document_definition(symbol_loc['uri'], **symbol_loc['range']['start'])
+        async with self.opened(fn):
+            prepared = await self.send_request('textDocument/prepareCallHierarchy', {
+                'textDocument': {'uri': symbol_loc['uri']},
+                'position': symbol_loc['range']['start'],
+            }, self.connection_for(fn))
 
-        # this means the symbol_loc is the actual definition
-        if definition['result'][0]['uri'].endswith('.h'):
-            definition = {'result': [symbol_loc]}
+        clangd_utils.check_resault(prepared)
 
-        return clangd_utils.extract_list(definition, self.workspace_path)
+        graph = call_graph.CallGraph(self.files, max_nodes)
+        roots = [graph.add_node(item) for item in prepared['result']]
 
-    async def find_symbol_references(self, symbol: str) -> Union[list, str]:
-        # find symbol location first
-        symbol_loc = await self.locate_symbol(symbol)
-        # open the file where the symbol is located
-        await self.did_open(clangd_utils.uri_to_fn(symbol_loc['uri']))
+        async def incoming_calls(item: dict) -> list:
+            # callers might live in any shard
+            return call_graph.merge_calls(await asyncio.gather(*[
+                self.send_request('callHierarchy/incomingCalls', {'item': item}, connection)
+                for connection in self.connections
+            ], return_exceptions=True), 'from')
+
+        async def outgoing_calls(item: dict) -> list:
+            # callees are found in the body, which belongs to one shard
+            return call_graph.check_calls(await self.send_request('callHierarchy/outgoingCalls', {
+                'item': item
+            }, self.connection_for(clangd_utils.uri_to_fn(item['uri']))))
+
+        if direction in ('incoming', 'both'):
+            await call_graph.expand(graph, roots, incoming_calls, True, depth, concurrency)
+        if direction in ('outgoing', 'both'):
+            await call_graph.expand(graph, roots, outgoing_calls, False, depth, concurrency)
+
+        return graph.to_dict()
+
+    def program_graph_path(self) -> str:
+        return os.path.join(clangd_utils.get_cache_dir(self.workspace_path), 'call_graph.npz')
+
+    def program_graph_status(self) -> dict:
+        status = {
+            'built': None != self.program_graph,
+            'building': None != self.program_graph_task and not self.program_graph_task.done(),
+            'scanned_files': self.program_graph_progress[0],
+            'total_files': self.program_graph_progress[1],
+            # the graph is not updated on edits, rebuild it when this grows
+            'changed_files': len(self.program_graph_stale),
+        }
+
+        if None != self.program_graph:
+            status['functions'] = len(self.program_graph)
+            status['calls'] = self.program_graph.edge_count()
 
-        # find symbol references
-        reference = await self.document_references(symbol_loc['uri'], **symbol_loc['range']['start'])
+        return status
 
-        return clangd_utils.extract_list(reference, self.workspace_path)
+    def build_program_graph(self) -> asyncio.Task:
+        program_graph.check_numpy()
 
-    async def locate_symbol(self, symbol: str) -> Union[list, str, bool, dict]:
-        symbol_resp = await self.workspace_symbol(symbol)
+        if None == self.program_graph_task or self.program_graph_task.done():
+            self.program_graph_task = background_task(self.__build_program_graph(), 'program_graph_task')
 
-        clangd_utils.check_resault(symbol_resp)
-        return symbol_resp['result'][0]['location']
+        return self.program_graph_task
+
+    async def __build_program_graph(self, concurrency: int = 4):
+        # outgoing calls are answered from the index
+        await self.wait_for_background_index_down()
+        await self.cdb_index_task
+
+        files = list(dict.fromkeys(self.cdb.files))
+        builder = program_graph.ProgramGraphBuilder(self.files)
+        # files are scanned a few at a time, their functions all at once
+        file_semaphore = asyncio.Semaphore(concurrency)
+        request_semaphore = asyncio.Semaphore(concurrency * 8)
+        self.program_graph_progress = [0, len(files)]
+
+        async def scan(file: str):
+            async with file_semaphore:
+                try:
+                    await self.__scan_functions(file, builder, request_semaphore)
+                except Exception as e:
+                    self.logger.warning(f'scan functions of {file} failed: {e}')
+                self.program_graph_progress[0] += 1
+
+        # edits made from here on might be missed by the scan
+        self.program_graph_stale.clear()
+
+        # files of a chunk are read and sent to clangd in one batch, clangd
+        # parses them while the first ones are scanned
+        chunk_size = max(1, min(concurrency * 2, self.max_opened_files // 2))
+        for i in range(0, len(files), chunk_size):
+            chunk = files[i:i + chunk_size]
+            await self.did_open_many(chunk)
+            await asyncio.gather(*[scan(file) for file in chunk])
+
+        graph = await asyncio.to_thread(builder.build)
+        await asyncio.to_thread(graph.save, self.program_graph_path())
+        self.program_graph = graph
+        self.logger.info(f'call graph built: {len(graph)} functions, {graph.edge_count()} calls')
+
+    async def __scan_functions(self, file: str, builder: program_graph.ProgramGraphBuilder,
+                               semaphore: asyncio.Semaphore):
+        uri = clangd_utils.fn_to_uri(file)
+        connection = self.connection_for(file)
+
+        async def calls_of(function: dict):
+            async with semaphore:
+                prepared = await self.send_request('textDocument/prepareCallHierarchy', {
+                    'textDocument': {'uri': uri},
+                    'position': function['selectionRange']['start'],
+                }, connection)
+
+                for item in prepared.get('result', None) or []:
+                    if builder.claim(item):
+                        builder.add_calls(item, call_graph.check_calls(await self.send_request(
+                            'callHierarchy/outgoingCalls', {'item': item}, connection)))
+
+        async with self.opened(file, connection):
+            symbols = await self.send_request('textDocument/documentSymbol', {
+                'textDocument': {'uri': uri}
+            }, connection)
+
+            await asyncio.gather(*[calls_of(function) for function in
+                                   program_graph.flatten_functions(symbols.get('result', None) or [])])
+
+    async def query_program_graph(self, query: str, symbol: str = '', depth: int = 0, limit: int = 50) -> dict:
+        # graph of a previous session
+        if None == self.program_graph and os.path.exists(self.program_graph_path()):
+            self.program_graph = await asyncio.to_thread(program_graph.ProgramGraph.load, self.program_graph_path())
+
+        if None == self.program_graph:
+            if None != self.program_graph_task and not self.program_graph_task.done():
+                raise RuntimeError(f'call graph is being built, {self.program_graph_progress[0]}/'
+                                   f'{self.program_graph_progress[1]} files scanned, please try again later')
+            raise RuntimeError('call graph is not built, please call build_call_graph first')
+
+        return await asyncio.to_thread(self.program_graph.query, query, symbol, depth, limit)
+
+    async def batch_find_symbol_definition(self, symbols: list[str]) -> tuple[dict, dict]:
+        return await self.__batch(self.find_symbol_definition, symbols)
+
+    async def batch_find_symbol_references(self, symbols: list[str]) -> tuple[dict, dict]:
+        return await self.__batch(self.find_symbol_references, symbols)
+
+    async def __batch(self, fn, symbols: list[str]) -> tuple[dict, dict]:
+        # drop duplicated symbols but keep the order
+        symbols = list(dict.fromkeys(symbols))
+
+        # all lookups are pipelined over the same clangd connection
+        results = await asyncio.gather(*[fn(symbol) for symbol in symbols], return_exceptions=True)
+
+        found, errors = {}, {}
+        for symbol, result in zip(symbols, results):
+            if isinstance(result, BaseException):
+                errors[symbol] = str(result)
+            else:
+                found[symbol] = result
+
+        return found, errors
+
+    async def locate_symbol(self, symbol: str) -> dict:
+        candidates, _ = await self.locate_symbols(symbol)
+        return candidates[0]['location']
+
+    async def locate_symbols(self, symbol: str, symbol_filter: SymbolFilter = None) -> tuple[list[dict], bool]:
+        symbol_filter = symbol_filter or SymbolFilter()
+        name = symbol
+
+        # without the watcher a branch switch is noticed by the next lookup
+        if None == self.watcher and None != self.git_head and self.git_head.moved():
+            await self.on_files_changed({})
+
+        # answers right after an edit should see it
+        try:
+            await asyncio.wait_for(self.changes_applied.wait(), remaining_time())
+        except TimeoutError:
+            raise RuntimeError('file changes are still being applied, please try again later')
+
+        # qualified c++ name, workspace symbols carry the qualifier as container
+        if '::' in symbol:
+            container, _, name = symbol.rpartition('::')
+            if not symbol_filter.container:
+                kinds = symbol_filter.kinds
+                symbol_filter = SymbolFilter(None, symbol_filter.file_glob, container.lstrip(':'))
+                symbol_filter.kinds = kinds
+
+        # symbol store answers without asking clangd, its locations are definitions
+        candidates = await asyncio.to_thread(self.symbol_store.lookup, name)
+        resolved = True
+
+        # all symbols are indexed once clangd finished its index
+        if not candidates and self.symbol_index_ready:
+            candidates = self.symbol_index.lookup(name)
+            # symbols of edited files come from their documents, with prototypes
+            resolved = not any(clangd_utils.uri_to_fn(candidate['location']['uri']) in self.document_symbol_files
+                               for candidate in candidates)
+
+        if not candidates:
+            fetch_time = time.time_ns()
+            symbol_resp = self.drop_deleted(await self.workspace_symbol(name), 'location')
+
+            clangd_utils.check_resault(symbol_resp)
+            # record symbols of the name for later sessions, a partial index
+            # might only know a declaration of it
+            if self.index_complete():
+                await asyncio.to_thread(self.record_symbols, [info for info in symbol_resp['result']
+                                                              if info['name'] == name], fetch_time, [name])
+            await asyncio.to_thread(self.symbol_index.add, symbol_resp['result'])
+
+            # query is fuzzy, keep the best hit when no name matches exactly
+            candidates = [info for info in symbol_resp['result'] if info['name'] == name] or symbol_resp['result'][:1]
+            resolved = False
+
+        matched = [candidate for candidate in candidates if symbol_filter.match(candidate, self.workspace_path)]
+
+        # tell the caller what is there, so the next try can pick the right one
+        if not matched:
+            raise RuntimeError(f'no {symbol} matches the given kind, file or container, candidates are: ' +
+                               '; '.join(describe_symbol(candidate, self.workspace_path) for candidate in candidates))
+
+        return matched, resolved
+
+    async def __build_symbol_index(self):
+        try:
+            # symbols of previous sessions are searchable at once
+            index = SymbolIndex(self.workspace_path)
+            await asyncio.to_thread(index.add, await asyncio.to_thread(self.symbol_store.all))
+            self.symbol_index = index
+
+            await self.__pull_symbol_index()
+        except Exception as e:
+            self.logger.warning(f'build symbol index failed: {e}')
+
+        # files changed meanwhile
+        await self.__refresh_symbol_index()
+
+    async def __pull_symbol_index(self):
+        # every symbol clangd knows, a fresh index is swapped in so searches
+        # are not blocked by the bulk load
+        await self.wait_for_background_index_down()
+        # changed files queued for parsing are done by then
+        while None != self.reparse_task and not self.reparse_task.done():
+            await asyncio.wait([self.reparse_task])
+        settled = set(self.unsettled_files)
+        fetch_time = time.time_ns()
+        # clangd can not page workspace/symbol, the whole index comes in one
+        # response that takes a while on large trees. nobody waits on it, so
+        # it is not bound by the request timeout
+        symbols = await self.workspace_symbol('', limit=0, timeout=0)
+        symbols = self.drop_deleted(symbols, 'location').get('result', None) or []
+
+        index = SymbolIndex(self.workspace_path)
+        await asyncio.to_thread(index.add, symbols)
+        await asyncio.to_thread(index.prepare)
+        self.symbol_index = index
+        self.symbol_index_ready = True
+        self.document_symbol_files.clear()
+        self.logger.info(f'symbol index built: {len(index)} symbols')
+
+        self.unsettled_files -= settled
+        await asyncio.to_thread(self.record_symbols, symbols, fetch_time)
+
+    async def __refresh_symbol_index(self):
+        while self.stale_symbol_files:
+            # let clangd reparse edited files, files edited meanwhile join in
+            await asyncio.sleep(SYMBOL_REFRESH_DELAY)
+            paths, self.stale_symbol_files = self.stale_symbol_files, set()
+
+            try:
+                # mass changes such as a branch switch are reindexed by clangd in background
+                if len(paths) > SYMBOL_REFRESH_LIMIT:
+                    await self.__pull_symbol_index()
+                else:
+                    await self.__refresh_files(sorted(paths))
+            except Exception as e:
+                self.logger.warning(f'refresh symbol index failed: {e}')
+
+    async def __refresh_files(self, paths: list[str], concurrency: int = 4):
+        # only the symbol index is refreshed, the symbol store keeps the
+        # definitions workspace/symbol reports
+        for begin in range(0, len(paths), concurrency):
+            batch = paths[begin:begin + concurrency]
+            results = await asyncio.gather(*[self.file_symbols(path) for path in batch], return_exceptions=True)
+
+            for path, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    self.logger.warning(f'refresh symbols of {path} failed: {result}')
+                    continue
+
+                await asyncio.to_thread(self.symbol_index.replace_file, path, result)
+                self.document_symbol_files.add(path)
+
+        self.logger.info(f'symbol index refreshed: {len(paths)} files')
+
+    async def file_symbols(self, path: str) -> list[dict]:
+        async with self.opened(path) as file:
+            response = await self.send_request('textDocument/documentSymbol', {
+                'textDocument': {'uri': clangd_utils.fn_to_uri(file)}
+            }, self.connection_for(file))
+
+        if 'error' in response:
+            raise RuntimeError(f'error occur: {response['error'].get('message', '')}')
+
+        return await asyncio.to_thread(flatten_document_symbols, file, response.get('result', None) or [])
+
+    def record_symbols(self, symbols: list[dict], fetch_time: int, names: list[str] = None):
+        # runs in a worker thread. clangd catches up with changed files in
+        # background, symbols of a file it might still hold an old version of
+        # would be recorded under the hash of the new content
+        settled: dict[str, bool] = {}
+        kept = []
+
+        for symbol in symbols:
+            path = clangd_utils.uri_to_fn(symbol['location']['uri'])
+            if path not in settled:
+                settled[path] = self.__is_settled(path)
+            if settled[path]:
+                kept.append(symbol)
+
+        self.symbol_store.update(kept, fetch_time, names)
+
+    def __is_settled(self, path: str) -> bool:
+        if path in self.unsettled_files:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        # changed while running, but not pushed to clangd yet
+        return stat.st_mtime_ns < self.start_time or self.applied_stamps.get(path, None) == (stat.st_mtime_ns, stat.st_size)
+
+    async def search_symbols(self, query: str, mode: str = 'substring', kinds: list[str] = None,
+                             limit: int = 50) -> tuple[int, list[dict]]:
+        return await asyncio.to_thread(self.symbol_index.search, query, mode, kinds, limit)
+
+
+# one client per workspace, at most max_clients of them keep their clangd
+# running, the least recently used one is stopped when another one starts
+class ClangdClientPool:
+    def __init__(self, max_clients: int = 2, **client_args):
+        self.max_clients = max(1, max_clients)
+        self.client_args = client_args
+        # workspace path -> client, in lru order
+        self.clients: OrderedDict[str, ClangdClient] = OrderedDict()
+        # workspace used when a tool does not name one
+        self.current = ''
+        self.lock = asyncio.Lock()
+
+    async def start(self, workspace_path: str = '', shards: int = 1) -> ClangdClient:
+        if '' == workspace_path:
+            raise RuntimeError('workspace_path cannot be a empty path')
+
+        workspace_path = os.path.abspath(workspace_path)
+
+        async with self.lock:
+            client = self.clients.get(workspace_path, None)
+            if None == client:
+                client = ClangdClient(**self.client_args)
+                self.clients[workspace_path] = client
+            self.clients.move_to_end(workspace_path)
+
+            # make room before starting another clangd
+            while len(self.clients) > self.max_clients:
+                evicted_path, evicted = self.clients.popitem(last=False)
+                client.logger.info(f'evict workspace: {evicted_path}')
+                await evicted.stop()
+
+            try:
+                await client.start(workspace_path, shards)
+            except BaseException:
+                del self.clients[workspace_path]
+                await client.stop()
+                raise
+
+            self.current = workspace_path
+            return client
+
+    def get(self, workspace_path: str = '') -> ClangdClient:
+        if '' == workspace_path:
+            workspace_path = self.current
+        workspace_path = os.path.abspath(workspace_path) if workspace_path else ''
+
+        client = self.clients.get(workspace_path, None)
+        # stopped client only holding a standby
+        if None == client or not client.connections:
+            if workspace_path and self.clients:
+                raise RuntimeError(f'analyzer of {workspace_path} is down, please call start_analyzer first')
+            raise RuntimeError('analyzer is down, please call start_analyzer first')
+
+        self.clients.move_to_end(workspace_path)
+        return client
+
+    async def stop(self, workspace_path: str = ''):
+        client = self.get(workspace_path)
+
+        async with self.lock:
+            workspace_path = client.workspace_path
+            await client.stop(keep_standby=True)
+
+            # a client with standby stays in pool, so that a later start is fast
+            if not client.standbys:
+                del self.clients[workspace_path]
+
+            if workspace_path == self.current:
+                self.current = next((path for path in reversed(self.clients) if self.clients[path].connections), '')
+
+    def get_status(self, workspace_path: str = '') -> dict:
+        try:
+            status = self.get(workspace_path).get_status()
+        except RuntimeError:
+            status = {'started': False}
+
+        status.update({
+            'current_workspace': self.current,
+            'workspaces': list(self.clients),
+            'max_workspaces': self.max_clients,
+        })
 
+        return status
 
 async def main():
     client = ClangdClient()
@@ -103,7 +103,7 @@ class ClangdClient:
         self.logger.debug('switch to workspace')
         os.chdir(self.workspace_path)
 
-        self.process, cdb_file, _ = create_clangd_process(self.workspace_path)
+        self.process, cdb_file, _ = create_clangd_process_blocked(self.workspace_path)
 
         with open(os.path.join(self.script_path, 'init_param.json'), encoding='utf-8') as f:
             param = json.loads(f.read())
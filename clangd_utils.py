@@ -1,9 +1,15 @@
 from urllib.parse import urlparse, unquote
 from urllib.request import pathname2url
 from packaging import version
-import fnmatch
+from typing import Union
+import hashlib
 import subprocess
+import sys
+import asyncio
+import json
 import os
+import re
+import tempfile
 
 def get_endl() -> str:
     if os.name == 'nt':
@@ -36,13 +42,215 @@ def extract_list(response: dict, workspace_path: str) -> list[str]:
 
     return res
 
-def search_cdb(path: str):
-    for root, dir, files in os.walk(path):
-        # print(f'root: {root}, _:{dir}, files: {files}')
-        for file_path in fnmatch.filter(files, 'compile_commands.json'):
-            return os.path.relpath(os.path.join(root, file_path), path)
+def top_level_dir(fn: str, workspace_path: str) -> str:
+    rel_path = os.path.relpath(fn, workspace_path)
+
+    # files outside of the workspace or in its root have no top level directory
+    if rel_path.startswith(os.pardir) or os.sep not in rel_path:
+        return ''
+
+    return rel_path.split(os.sep, 1)[0]
+
+# value of a --name=value command line option
+def get_option(name: str, default: str = '') -> str:
+    prefix = f'--{name}='
+
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix):]
+
+    return default
+
+def user_cache_dir() -> str:
+    if 'win32' == sys.platform:
+        root = os.environ.get('LOCALAPPDATA', '') or os.path.expanduser('~')
+    else:
+        root = os.environ.get('XDG_CACHE_HOME', '') or os.path.join(os.path.expanduser('~'), '.cache')
+
+    return os.path.join(root, 'code-analysis-mcp')
+
+def get_cache_dir(workspace_path: str) -> str:
+    # a read-only checkout keeps its cache in the user cache directory, one
+    # directory per workspace path, or in the temp directory at last
+    name = f'{os.path.basename(workspace_path)}-{hashlib.sha1(workspace_path.encode()).hexdigest()[:12]}'
+    candidates = [
+        os.path.join(workspace_path, '.cache', 'code-analysis-mcp'),
+        os.path.join(user_cache_dir(), name),
+        os.path.join(tempfile.gettempdir(), 'code-analysis-mcp', name),
+    ]
+
+    for cache_dir in candidates:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            continue
+        if os.access(cache_dir, os.W_OK):
+            return cache_dir
+
+    raise RuntimeError(f'no writable cache directory for {workspace_path}')
+
+def merge_results(responses: list) -> dict:
+    merged = {}
+
+    for response in responses:
+        # shard without any result
+        if isinstance(response, BaseException):
+            continue
+
+        for ref in response['result']:
+            start = ref['range']['start']
+            merged.setdefault((ref['uri'], start['line'], start['character']), ref)
+
+    if not merged:
+        raise RuntimeError('result not found')
+
+    return {'result': list(merged.values())}
+
+# location is the start of a symbol inside the range of another location
+def location_contains(outer: Union[dict, None], location: dict) -> bool:
+    # clangd and fn_to_uri spell file uris differently
+    if None == outer or uri_to_fn(outer['uri']) != uri_to_fn(location['uri']):
+        return False
+
+    position = location['range']['start']
+    position = (position['line'], position['character'])
+    start, end = outer['range']['start'], outer['range']['end']
+    return (start['line'], start['character']) <= position <= (end['line'], end['character'])
+
+# lsp position of a character offset, characters are counted in utf-16 code units
+def text_position(text: str, offset: int) -> dict:
+    line = text.count('\n', 0, offset)
+    line_start = text.rfind('\n', 0, offset) + 1
+    return {'line': line, 'character': len(text[line_start:offset].encode('utf-16-le')) // 2}
+
+# single incremental change turning old into new, the differing middle part
+# between the common head and tail is replaced, None when nothing changed
+def text_edit(old: str, new: str) -> Union[dict, None]:
+    if old == new:
+        return None
+
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+
+    # common head and tail are compared by whole lines first
+    head = 0
+    while head < min(len(old_lines), len(new_lines)) and old_lines[head] == new_lines[head]:
+        head += 1
+    start = sum(len(line) for line in old_lines[:head])
+
+    tail = 0
+    while tail < min(len(old_lines), len(new_lines)) - head and old_lines[-1 - tail] == new_lines[-1 - tail]:
+        tail += 1
+    old_end = len(old) - sum(len(line) for line in old_lines[len(old_lines) - tail:])
+    new_end = len(new) - (len(old) - old_end)
+
+    # then by characters within the differing lines
+    while start < min(old_end, new_end) and old[start] == new[start]:
+        start += 1
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    return {
+        'range': {
+            'start': text_position(old, start),
+            'end': text_position(old, old_end),
+        },
+        'text': new[start:new_end],
+    }
+
+CDB_NAME = 'compile_commands.json'
+# conventional places of compile_commands.json, checked before walking the tree
+CDB_CONVENTIONAL_DIRS = ['', 'build', 'builddir', 'out', 'output', 'cmake-build-debug', 'cmake-build-release']
+# directories never contain the cdb but might be huge
+CDB_IGNORED_DIRS = {'node_modules', 'vendor', 'third_party', '__pycache__', 'venv'}
+CDB_SEARCH_DEPTH = 4
+
+# workspace path -> cdb path relative to the workspace
+__cdb_locations: dict[str, str] = {}
+
+def read_clangd_config_cdb(path: str) -> Union[str, None]:
+    try:
+        with open(os.path.join(path, '.clangd'), encoding='utf-8') as f:
+            config = f.read()
+    except OSError:
+        return None
+
+    # CompileFlags: CompilationDatabase: <dir>
+    match = re.search(r'^\s*CompilationDatabase\s*:\s*(.+?)\s*$', config, re.MULTILINE)
+    if None == match:
+        return None
+
+    return match.group(1).strip('\'"')
+
+def walk_cdb(path: str, max_depth: int) -> Union[str, None]:
+    # breadth first, a cdb near the root is preferred
+    level = [path]
+
+    for _ in range(max_depth + 1):
+        next_level = []
+
+        for root in level:
+            try:
+                entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            for entry in entries:
+                if entry.name == CDB_NAME and entry.is_file():
+                    return entry.path
+
+                if entry.is_dir(follow_symlinks=False) and \
+                    not entry.name.startswith('.') and entry.name not in CDB_IGNORED_DIRS:
+                    next_level.append(entry.path)
+
+        level = next_level
+
     return None
 
+def search_cdb(path: str, max_depth: int = CDB_SEARCH_DEPTH):
+    cache_file = os.path.join(get_cache_dir(path), 'cdb_location.json')
+
+    # location found before, in this process or a previous one
+    cdb_file = __cdb_locations.get(path, None)
+    if None == cdb_file:
+        try:
+            with open(cache_file, encoding='utf-8') as f:
+                cdb_file = json.load(f)['cdb']
+        except (OSError, ValueError, KeyError):
+            cdb_file = None
+
+    if None != cdb_file and os.path.isfile(os.path.join(path, cdb_file)):
+        __cdb_locations[path] = cdb_file
+        return cdb_file
+
+    candidates = [os.path.join(path, dir, CDB_NAME) for dir in CDB_CONVENTIONAL_DIRS]
+
+    # directory set by .clangd has the highest priority
+    config_dir = read_clangd_config_cdb(path)
+    if None != config_dir:
+        candidates.insert(0, os.path.join(path, config_dir, CDB_NAME))
+
+    cdb_file = next((file for file in candidates if os.path.isfile(file)), None)
+
+    if None == cdb_file:
+        cdb_file = walk_cdb(path, max_depth)
+
+    if None == cdb_file:
+        return None
+
+    cdb_file = os.path.relpath(cdb_file, path)
+    __cdb_locations[path] = cdb_file
+
+    # only saves the next search
+    try:
+        with open(cache_file, 'w', encoding='utf-8') as f:
+            json.dump({'cdb': cdb_file}, f)
+    except OSError:
+        pass
+
+    return cdb_file
+
 def find_clangd(check_name: str = 'clangd'):
     clangd_abs_path = ''
 
@@ -98,7 +306,7 @@ def find_clangd(check_name: str = 'clangd'):
 
     return None
 
-def create_clangd_process(cwd: str, *clangd_args, clangd_path: str = find_clangd()):
+def get_clangd_args(cwd: str, *clangd_args, clangd_path: str, cdb_path: str = None):
     __clangd_args = [
         clangd_path,
         '--function-arg-placeholders=1',
@@ -111,15 +319,25 @@ def create_clangd_process(cwd: str, *clangd_args, clangd_path: str = find_clangd
         # '--background-index',
     ]
 
-    cdb_file = search_cdb(cwd)
-    cdb_path = os.path.dirname(cdb_file)
-
+    # search the workspace unless the cdb directory is given
     if None == cdb_path:
-        raise RuntimeError('no compile_commands.json found')
-    
+        cdb_file = search_cdb(cwd)
+
+        if None == cdb_file:
+            raise RuntimeError('no compile_commands.json found')
+
+        cdb_path = os.path.dirname(cdb_file)
+    else:
+        cdb_file = os.path.join(cdb_path, CDB_NAME)
+
     __clangd_args.append(f'--compile-commands-dir={cdb_path}')
     __clangd_args.extend(clangd_args)
 
+    return __clangd_args, cdb_file
+
+def create_clangd_process_blocked(cwd: str, *clangd_args, clangd_path: str = find_clangd()):
+    __clangd_args, cdb_file = get_clangd_args(cwd, *clangd_args, clangd_path=clangd_path)
+
     process = subprocess.Popen(
         executable=clangd_path,
         args=__clangd_args,
@@ -133,3 +351,81 @@ def create_clangd_process(cwd: str, *clangd_args, clangd_path: str = find_clangd
         raise RuntimeError('start clangd fail')
 
     return process, cdb_file, clangd_path
+
+async def create_clangd_process(cwd: str, *clangd_args, clangd_path: str = find_clangd(), cdb_path: str = None):
+    __clangd_args, cdb_file = get_clangd_args(cwd, *clangd_args, clangd_path=clangd_path, cdb_path=cdb_path)
+
+    process = await asyncio.create_subprocess_exec(
+        *__clangd_args,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+    )
+
+    return process, cdb_file, clangd_path
+
+def encode_message(message: dict) -> bytes:
+    body = json.dumps(message).encode()
+    return b'Content-Length: %d\r\n\r\n' % len(body) + body
+
+# incremental parser for Content-Length framed messages, payloads are decoded
+# straight from a memoryview of the receive buffer
+class MessageFramer:
+    HEADER_FIELD = b'Content-Length:'
+    HEADER_END = b'\r\n\r\n'
+    # bigger payloads are returned encoded, decoding them would block the loop
+    LARGE_PAYLOAD = 1 << 20
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> tuple[list[Union[dict, bytes]], list[str]]:
+        messages = []
+        logs = []
+        pos = 0
+
+        self.buffer += data
+
+        with memoryview(self.buffer) as view:
+            while True:
+                header = self.buffer.find(self.HEADER_FIELD, pos)
+
+                # no header in buffer, only complete lines can be treated as log
+                if -1 == header:
+                    line_end = self.buffer.rfind(b'\n', pos)
+                    if -1 != line_end:
+                        logs.extend(str(view[pos:line_end], 'utf-8', 'replace').splitlines())
+                        pos = line_end + 1
+                    break
+
+                # data before the header is log information
+                if header > pos:
+                    logs.extend(str(view[pos:header], 'utf-8', 'replace').splitlines())
+                    pos = header
+
+                header_end = self.buffer.find(self.HEADER_END, header)
+                # header is not complete yet
+                if -1 == header_end:
+                    break
+
+                length_end = self.buffer.find(b'\r\n', header)
+                length = int(self.buffer[header + len(self.HEADER_FIELD):length_end])
+
+                payload_start = header_end + len(self.HEADER_END)
+                payload_end = payload_start + length
+                # payload is not complete yet
+                if payload_end > len(self.buffer):
+                    break
+
+                # decode json from the exact payload slice
+                if length > self.LARGE_PAYLOAD:
+                    messages.append(bytes(view[payload_start:payload_end]))
+                else:
+                    messages.append(json.loads(str(view[payload_start:payload_end], 'utf-8')))
+                pos = payload_end
+
+        # drop consumed data
+        del self.buffer[:pos]
+
+        return messages, [log for log in logs if log]
@@ -7,16 +7,41 @@ from collections.abc import Sequence
 import json
 
 from tools import tool_list
+from cache import SingleFlight
 
 server = Server('code-analysis-mcp',
 instructions='''This MCP server provides a set of tools for code analysis, enabling fast and precise symbol lookup. When using these tools, you should first call start_analyzer to initialize the analyzer, passing the root directory of the code as a parameter. Once the analyzer is started, other interfaces can be invoked.
 
+The analyzer keeps indexing the code in background after start_analyzer returns, queries are answered at once and carry an index_complete flag, results might be incomplete while it is false. The analyzer_status tool reports the index progress.
+
+Edited source files are picked up automatically, there is no need to restart the analyzer after changing code. Switching git branches or resetting to another commit is picked up as well, only the files differing between the two commits are parsed again, analyzer_status reports the checked out commit and how many files are still waiting to be parsed. The call graph of build_call_graph is not updated on edits, analyzer_status reports how many files changed since it was built.
+
+Several code roots can be analyzed at the same time, call start_analyzer for each of them. Every tool accepts an optional workspace_path to choose the code root, the most recently used one is taken when it is omitted. Only a few analyzers are kept running, the least recently used one is stopped when more are started, call start_analyzer again to bring it back.
+
 The find_definition tool provides functionality to locate the position where a variable or function is defined. It is typically used during code analysis when you need to inspect the implementation of a called function. This tool requires a variable name or function name as a parameter.
 
-The find_references tool enables locating the positions where a variable or function is referenced or used. It is commonly used to determine where a specific function is called during code analysis. Like find_definition, this tool also requires a variable name or function name as a parameter.''',
+The find_references tool enables locating the positions where a variable or function is referenced or used. It is commonly used to determine where a specific function is called during code analysis. Like find_definition, this tool also requires a variable name or function name as a parameter.
+
+Large reference sets are returned in pages of limit entries together with the total count, pass the next_cursor of a page back as cursor to get the following page without searching again. Set group_by_file to get the reference count and lines of every file instead, which is much smaller for widely used symbols.
+
+When several symbols share a name, such as static functions in different files or fields of different structs, find_definition and find_references cover all of them. Narrow them down with kinds, file_glob or container, or a qualified name like ns::name; when nothing matches, the error lists the candidates.
+
+The batch_find_definitions and batch_find_references tools do the same for a list of symbols in one call, prefer them when many symbols are needed at once. The result maps every symbol to its positions, symbols that cannot be resolved are reported in errors.
+
+The search_symbols tool finds symbols by part of their name (substring, prefix, regex or fuzzy) with optional kind filters, answered from a local index in well under a millisecond. Use it when the exact name is unknown or ambiguous, then pass the found name to the other tools.
+
+The call_hierarchy tool returns the callers (direction incoming) or the callees (direction outgoing) of a function several levels deep in one call, as a list of functions and [caller, callee, call sites] edges between them. Prefer it over repeated find_references calls when following call chains.
+
+The build_call_graph tool walks every function of the code base once in background and keeps the whole call graph on disk. Afterwards query_call_graph answers which functions a function can reach, which functions can reach it (for example who can end up in an interrupt handler) and which functions have the most callers or callees, in milliseconds. The analyzer_status tool reports the build progress.
+
+The get_compile_command tool returns the compile command of a source file, which shows the include paths and macros used to build it.
+
+The get_analyzer_log tool returns the latest log lines of the analyzer backend. It is only needed when the other tools behave unexpectedly.''',
 )
 
 tool_table = {}
+# identical concurrent lookups share one execution
+tool_flight = SingleFlight()
 
 @server.list_tools()
 async def list_tools() -> list[Tool]:
@@ -36,7 +61,14 @@ async def call_tool(name: str, arg: Any) -> Sequence[TextContent]:
     if name not in tool_table:
         raise ValueError(f'unknow tool: {name}')
 
-    result = await tool_table[name].exec(arg)
+    tool = tool_table[name]
+    # tools changing the analyzer run every time, a later start should not
+    # join an earlier one across a stop
+    if getattr(tool, 'coalesce', False):
+        key = (name, json.dumps(arg, sort_keys=True))
+        result = await tool_flight.do(key, lambda: tool.exec(arg))
+    else:
+        result = await tool.exec(arg)
 
     if None == result:
         result = True
@@ -0,0 +1,96 @@
+from typing import Union
+import asyncio
+import os
+
+from watcher import CREATED, CHANGED, DELETED, is_watched
+
+# --name-status letters, renames are split into a delete and an add
+STATUS_CHANGES = {'A': CREATED, 'D': DELETED}
+
+async def run_git(cwd: str, *args: str) -> str:
+    process = await asyncio.create_subprocess_exec(
+        'git', *args, cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await process.communicate()
+
+    if 0 != process.returncode:
+        raise RuntimeError(f'git {args[0]} failed: {stderr.decode(errors='replace').strip()}')
+
+    return stdout.decode(errors='surrogateescape')
+
+# commit checked out in the workspace, a checkout, reset or rebase moves it and
+# only the files differing between the two commits are changed on disk
+class GitHead:
+    def __init__(self, workspace_path: str):
+        self.workspace_path = workspace_path
+        self.git_dir = ''
+        self.commit = ''
+        self.stamp = None
+
+    @classmethod
+    async def open(cls, workspace_path: str) -> Union['GitHead', None]:
+        head = cls(workspace_path)
+
+        try:
+            head.git_dir = (await run_git(workspace_path, 'rev-parse', '--absolute-git-dir')).strip()
+            head.commit = await head.rev_parse()
+        except (OSError, RuntimeError):
+            # not a git work tree, or git is not installed
+            return None
+
+        head.stamp = head.get_stamp()
+        return head
+
+    def trigger_files(self) -> list[str]:
+        # HEAD is rewritten on branch switches, its reflog grows on every move
+        return [os.path.join(self.git_dir, 'HEAD'), os.path.join(self.git_dir, 'logs', 'HEAD')]
+
+    def get_stamp(self) -> tuple:
+        stamp = []
+
+        for path in self.trigger_files():
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stamp.append(None)
+
+        return tuple(stamp)
+
+    def moved(self) -> bool:
+        # only a stat, cheap enough to check before every lookup
+        return self.get_stamp() != self.stamp
+
+    async def rev_parse(self) -> str:
+        try:
+            return (await run_git(self.workspace_path, 'rev-parse', '--verify', '-q', 'HEAD')).strip()
+        except RuntimeError:
+            # no commit yet
+            return ''
+
+    async def changes(self) -> dict[str, int]:
+        # absolute path -> change type of source files under the workspace
+        self.stamp = self.get_stamp()
+        commit = await self.rev_parse()
+
+        if commit == self.commit:
+            return {}
+
+        previous, self.commit = self.commit, commit
+        if not previous or not commit:
+            return {}
+
+        # --relative limits the diff to the workspace, which might be a sub
+        # directory of the work tree
+        fields = (await run_git(self.workspace_path, 'diff', '--name-status', '--no-renames', '--relative',
+                                '-z', previous, commit)).split('\0')
+
+        changes = {}
+        for status, path in zip(fields[0::2], fields[1::2]):
+            path = os.path.normpath(os.path.join(self.workspace_path, path))
+            if is_watched(path):
+                changes[path] = STATUS_CHANGES.get(status[:1], CHANGED)
+
+        return changes
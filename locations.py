@@ -0,0 +1,101 @@
+from array import array
+from typing import Iterator
+import os
+
+import clangd_utils
+
+# interned file paths of a workspace, every uri is converted and every path is
+# made relative only once no matter how many locations point into the file
+class FileTable:
+    def __init__(self, workspace_path: str):
+        self.workspace_path = workspace_path
+        # file id -> absolute path
+        self.paths: list[str] = []
+        # file id -> path relative to the workspace, computed on first use
+        self.relative_paths: list[str] = []
+        self.uri_ids: dict[str, int] = {}
+        self.path_ids: dict[str, int] = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    def intern_path(self, path: str) -> int:
+        file_id = self.path_ids.get(path, None)
+
+        if None == file_id:
+            file_id = len(self.paths)
+            self.paths.append(path)
+            self.relative_paths.append(None)
+            self.path_ids[path] = file_id
+
+        return file_id
+
+    def intern_uri(self, uri: str) -> int:
+        file_id = self.uri_ids.get(uri, None)
+
+        if None == file_id:
+            file_id = self.intern_path(clangd_utils.uri_to_fn(uri))
+            self.uri_ids[uri] = file_id
+
+        return file_id
+
+    def relative(self, file_id: int) -> str:
+        rel_path = self.relative_paths[file_id]
+
+        if None == rel_path:
+            rel_path = os.path.relpath(self.paths[file_id], self.workspace_path)
+            self.relative_paths[file_id] = rel_path
+
+        return rel_path
+
+# locations of a response as columns instead of nested dicts, shared by the
+# result cache, paged answers and the call graph
+class LocationList:
+    def __init__(self, files: FileTable):
+        self.files = files
+        self.file_ids = array('I')
+        self.lines = array('I')
+        self.characters = array('I')
+
+    @classmethod
+    def from_response(cls, response: dict, files: FileTable) -> 'LocationList':
+        locations = cls(files)
+
+        for ref in response['result']:
+            start = ref['range']['start']
+            locations.append(files.intern_uri(ref['uri']), start['line'], start['character'])
+
+        return locations
+
+    def append(self, file_id: int, line: int, character: int):
+        self.file_ids.append(file_id)
+        self.lines.append(line)
+        self.characters.append(character)
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def __iter__(self) -> Iterator[tuple[int, int, int]]:
+        return zip(self.file_ids, self.lines, self.characters)
+
+    def paths(self) -> set[str]:
+        return set(self.files.paths[file_id] for file_id in set(self.file_ids))
+
+    def to_list(self, start: int = 0, end: int = None) -> list[str]:
+        relative = self.files.relative
+
+        return [f'{relative(file_id)}:{line}' for file_id, line in
+                zip(self.file_ids[start:end], self.lines[start:end])]
+
+    def group_by_file(self) -> list[dict]:
+        # file id -> lines, in order of first appearance
+        groups: dict[int, list[int]] = {}
+
+        for file_id, line in zip(self.file_ids, self.lines):
+            groups.setdefault(file_id, []).append(line)
+
+        return [{
+            'file': self.files.relative(file_id),
+            'count': len(lines),
+            'lines': lines,
+        } for file_id, lines in groups.items()]
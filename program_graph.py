@@ -0,0 +1,212 @@
+from array import array
+from typing import Hashable
+import sys
+
+from call_graph import item_key
+from locations import FileTable
+
+# numpy is only needed by the whole program call graph
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# symbol kinds of functions in document symbols
+FUNCTION_KINDS = {6, 9, 12}
+
+QUERIES = ('reachable_from', 'can_reach', 'fan_in', 'fan_out')
+
+def check_numpy():
+    if None == np:
+        raise RuntimeError('numpy is required by the call graph, please install it by: pip install numpy')
+
+def flatten_functions(symbols: list[dict]) -> list[dict]:
+    functions = []
+
+    for symbol in symbols:
+        if symbol.get('kind', None) in FUNCTION_KINDS:
+            functions.append(symbol)
+        # methods are children of classes
+        functions.extend(flatten_functions(symbol.get('children', None) or []))
+
+    return functions
+
+def item_extent(item: dict) -> tuple[int, int]:
+    start, end = item['range']['start'], item['range']['end']
+    return (end['line'] - start['line'], end['character'] - start['character'])
+
+# collects functions and calls of the workspace, node ids are handed out in
+# order of appearance and calls are kept as two edge columns
+class ProgramGraphBuilder:
+    def __init__(self, files: FileTable):
+        self.files = files
+        self.node_ids: dict[Hashable, int] = {}
+        self.names: list[str] = []
+        self.file_ids = array('I')
+        self.lines = array('I')
+        # size of the declaration a node is located at
+        self.extents: list[tuple[int, int]] = []
+        self.callers = array('I')
+        self.callees = array('I')
+        # functions whose outgoing calls are fetched already
+        self.claimed: set[Hashable] = set()
+
+    def add_node(self, item: dict, definition: bool = False) -> int:
+        key = item_key(item)
+        start = item['selectionRange']['start']
+        # items from the index are located at the definition, other items span
+        # their whole declaration, the body makes a definition the widest
+        extent = (sys.maxsize, 0) if definition else item_extent(item)
+        node = self.node_ids.get(key, None)
+
+        if None == node:
+            node = len(self.names)
+            self.node_ids[key] = node
+            self.names.append(item['name'])
+            self.file_ids.append(self.files.intern_uri(item['uri']))
+            self.lines.append(start['line'])
+            self.extents.append(extent)
+        elif extent > self.extents[node]:
+            self.file_ids[node] = self.files.intern_uri(item['uri'])
+            self.lines[node] = start['line']
+            self.extents[node] = extent
+
+        return node
+
+    def claim(self, item: dict) -> bool:
+        # a function is scanned at its prototype and at its definition, its
+        # calls are fetched only once
+        self.add_node(item)
+        key = item_key(item)
+
+        if key in self.claimed:
+            return False
+
+        self.claimed.add(key)
+        return True
+
+    def add_calls(self, item: dict, calls: list[dict]):
+        caller = self.add_node(item)
+
+        for call in calls:
+            self.callers.append(caller)
+            self.callees.append(self.add_node(call['to'], True))
+
+    def build(self) -> 'ProgramGraph':
+        check_numpy()
+
+        count = len(self.names)
+        callers = np.frombuffer(self.callers, dtype=np.uint32).astype(np.int64)
+        callees = np.frombuffer(self.callees, dtype=np.uint32).astype(np.int64)
+
+        # sorted unique edges, a function calling another twice is one edge
+        edges = np.unique(callers * max(1, count) + callees)
+        callers, callees = np.divmod(edges, max(1, count))
+
+        indptr = np.zeros(count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(callers, minlength=count), out=indptr[1:])
+
+        locations = [f'{self.files.relative(file_id)}:{line}' for file_id, line in zip(self.file_ids, self.lines)]
+
+        return ProgramGraph(self.names, locations, indptr, callees.astype(np.int32))
+
+# call graph of the whole workspace in csr form, the callees of node n are
+# indices[indptr[n]:indptr[n + 1]], queries work on whole arrays at once
+class ProgramGraph:
+    def __init__(self, names: list[str], locations: list[str], indptr, indices):
+        check_numpy()
+
+        self.names = names
+        self.locations = locations
+        self.indptr = indptr
+        self.indices = indices
+        # caller of every edge, so both directions are walked by masking edges
+        self.sources = np.repeat(np.arange(len(names), dtype=np.int32), np.diff(indptr))
+
+        self.name_index: dict[str, list[int]] = {}
+        for node, name in enumerate(names):
+            self.name_index.setdefault(name, []).append(node)
+
+    def __len__(self):
+        return len(self.names)
+
+    def edge_count(self) -> int:
+        return len(self.indices)
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, names=np.array(self.names, dtype=str),
+                                locations=np.array(self.locations, dtype=str),
+                                indptr=self.indptr, indices=self.indices)
+
+    @classmethod
+    def load(cls, path: str) -> 'ProgramGraph':
+        check_numpy()
+
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['names'].tolist(), data['locations'].tolist(), data['indptr'], data['indices'])
+
+    def nodes_of(self, name: str) -> list[int]:
+        nodes = self.name_index.get(name, None)
+
+        if None == nodes:
+            raise RuntimeError(f'{name} is not a function in the call graph')
+
+        return nodes
+
+    def reach(self, starts: list[int], reverse: bool = False, depth: int = 0):
+        # distance of every node from the starts, -1 for unreachable ones
+        distances = np.full(len(self.names), -1, dtype=np.int32)
+        distances[starts] = 0
+
+        frontier = np.zeros(len(self.names), dtype=bool)
+        frontier[starts] = True
+        level = 0
+
+        while frontier.any() and (depth <= 0 or level < depth):
+            level += 1
+
+            # edges leaving the frontier, towards callers when reversed
+            if reverse:
+                reached = self.sources[frontier[self.indices]]
+            else:
+                reached = self.indices[frontier[self.sources]]
+
+            frontier = np.zeros(len(self.names), dtype=bool)
+            frontier[reached] = True
+            frontier &= distances < 0
+            distances[frontier] = level
+
+        return distances
+
+    def describe(self, nodes, **columns) -> list[dict]:
+        return [{
+            'name': self.names[node],
+            'location': self.locations[node],
+            **{key: int(values[n]) for key, values in columns.items()},
+        } for n, node in enumerate(nodes.tolist())]
+
+    def query(self, query: str, name: str = '', depth: int = 0, limit: int = 50) -> dict:
+        if 'reachable_from' == query or 'can_reach' == query:
+            distances = self.reach(self.nodes_of(name), 'can_reach' == query, depth)
+            nodes = np.flatnonzero(distances > 0)
+            # nearest first
+            nodes = nodes[np.argsort(distances[nodes], kind='stable')]
+            values = {'distance': distances[nodes]}
+        elif 'fan_in' == query or 'fan_out' == query:
+            if 'fan_in' == query:
+                counts = np.bincount(self.indices, minlength=len(self.names))
+            else:
+                counts = np.diff(self.indptr)
+            nodes = np.argsort(-counts, kind='stable')
+            nodes = nodes[counts[nodes] > 0]
+            values = {'count': counts[nodes]}
+        else:
+            raise RuntimeError(f'query should be one of {', '.join(QUERIES)}')
+
+        total = len(nodes)
+        if limit > 0:
+            nodes = nodes[:limit]
+            values = {key: value[:limit] for key, value in values.items()}
+
+        return {'total': total, 'result': self.describe(nodes, **values)}
@@ -0,0 +1,362 @@
+from array import array
+from typing import Iterable, Union
+import bisect
+import fnmatch
+import heapq
+import threading
+import os
+import re
+
+import clangd_utils
+from locations import FileTable
+
+# names of lsp symbol kinds, index is the kind number. clangd reports macros
+# as string, which no c or c++ symbol is otherwise
+SYMBOL_KINDS = [
+    '', 'file', 'module', 'namespace', 'package', 'class', 'method', 'property',
+    'field', 'constructor', 'enum', 'interface', 'function', 'variable', 'constant',
+    'macro', 'number', 'boolean', 'array', 'object', 'key', 'null', 'enum_member',
+    'struct', 'event', 'operator', 'type_parameter',
+]
+
+MODES = ('substring', 'prefix', 'regex', 'fuzzy')
+
+# characters that end a literal run of a regex
+REGEX_META = set('.^$*+?{}[]\\|()')
+# stop narrowing candidates down by posting lists below this, checking the
+# name itself is cheaper then
+NARROW_LIMIT = 256
+
+def contains(postings: array, symbol_id: int) -> bool:
+    i = bisect.bisect_left(postings, symbol_id)
+    return i < len(postings) and postings[i] == symbol_id
+
+def trigrams(text: str) -> set[str]:
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+def kind_number(kind: str) -> int:
+    try:
+        return SYMBOL_KINDS.index(kind.lower())
+    except ValueError:
+        raise RuntimeError(f'unknown symbol kind: {kind}, should be one of {', '.join(SYMBOL_KINDS[1:])}')
+
+# optional qualifiers picking some of the symbols sharing a name
+class SymbolFilter:
+    def __init__(self, kinds: list[str] = None, file_glob: str = '', container: str = ''):
+        self.kinds = set(kind_number(kind) for kind in kinds) if kinds else None
+        self.file_glob = file_glob
+        self.container = container
+
+    def key(self) -> tuple:
+        return (tuple(sorted(self.kinds or ())), self.file_glob, self.container)
+
+    def match(self, symbol: dict, workspace_path: str) -> bool:
+        if None != self.kinds and symbol['kind'] not in self.kinds:
+            return False
+
+        if self.container:
+            container = symbol.get('containerName', '') or ''
+            if container != self.container and not container.endswith('::' + self.container):
+                return False
+
+        if self.file_glob:
+            path = clangd_utils.uri_to_fn(symbol['location']['uri'])
+            rel_path = os.path.relpath(path, workspace_path)
+            # a glob without directory matches the file name in any directory
+            if not fnmatch.fnmatch(rel_path, self.file_glob) and \
+                not fnmatch.fnmatch(os.path.basename(path), self.file_glob):
+                return False
+
+        return True
+
+def describe_symbol(symbol: dict, workspace_path: str) -> str:
+    kind = symbol['kind']
+    rel_path = os.path.relpath(clangd_utils.uri_to_fn(symbol['location']['uri']), workspace_path)
+    container = symbol.get('containerName', '') or ''
+
+    return (f'{SYMBOL_KINDS[kind] if kind < len(SYMBOL_KINDS) else kind} '
+            f'{container + '::' if container else ''}{symbol['name']} '
+            f'at {rel_path}:{symbol['location']['range']['start']['line']}')
+
+def regex_literals(pattern: str) -> list[str]:
+    # alternatives make every literal optional
+    if '|' in pattern:
+        return []
+
+    literals, run, depth, i = [], '', 0, 0
+
+    while i < len(pattern):
+        c = pattern[i]
+
+        if c in REGEX_META:
+            # a quantifier makes the last character optional
+            if c in '?*{' and run:
+                run = run[:-1]
+            if 0 == depth:
+                literals.append(run)
+            run = ''
+
+            if '\\' == c:
+                i += 1
+            elif '[' == c:
+                # skip the character class
+                i = pattern.find(']', i + 2)
+                if i < 0:
+                    break
+            elif '{' == c:
+                # skip the bounds of the repeat
+                i = pattern.find('}', i + 1)
+                if i < 0:
+                    break
+            elif '(' == c:
+                depth += 1
+            elif ')' == c:
+                depth = max(0, depth - 1)
+        else:
+            run += c
+
+        i += 1
+
+    if 0 == depth:
+        literals.append(run)
+
+    return [literal for literal in literals if len(literal) >= 3]
+
+# in-process index of workspace symbols, names are lower cased and split into
+# trigrams, a search intersects the posting lists of the trigrams of the query
+# and only checks the few candidates left
+class SymbolIndex:
+    def __init__(self, workspace_path: str):
+        # symbols are added from worker threads, searched from the event loop
+        self.lock = threading.Lock()
+        self.files = FileTable(workspace_path)
+        self.__reset()
+
+    def __reset(self):
+        # symbol columns, symbol id is the position
+        self.names: list[str] = []
+        self.lower_names: list[str] = []
+        self.kinds = array('B')
+        self.containers: list[str] = []
+        self.file_ids = array('I')
+        self.lines = array('I')
+        self.characters = array('I')
+        # removed symbols stay in the posting lists until compaction
+        self.alive = bytearray()
+        self.removed = 0
+
+        # (name, path, line, character) -> symbol id
+        self.keys: dict[tuple, int] = {}
+        # file id -> symbol ids
+        self.file_symbols: dict[int, list[int]] = {}
+        # trigram -> ascending symbol ids
+        self.postings: dict[str, array] = {}
+        # (lower name, symbol id) sorted for prefix search, rebuilt on demand
+        self.sorted_names: list[tuple[str, int]] = None
+
+    def __len__(self):
+        return len(self.names) - self.removed
+
+    def add(self, symbols: Iterable[dict]):
+        with self.lock:
+            for symbol in symbols:
+                self.__add(symbol)
+
+    def __add(self, symbol: dict):
+        path = clangd_utils.uri_to_fn(symbol['location']['uri'])
+        start = symbol['location']['range']['start']
+        key = (symbol['name'], path, start['line'], start['character'])
+
+        symbol_id = self.keys.get(key, None)
+        if None != symbol_id and self.alive[symbol_id]:
+            return
+
+        symbol_id = len(self.names)
+        file_id = self.files.intern_path(path)
+        lower_name = symbol['name'].lower()
+
+        self.keys[key] = symbol_id
+        self.names.append(symbol['name'])
+        self.lower_names.append(lower_name)
+        self.kinds.append(symbol['kind'] if symbol['kind'] < len(SYMBOL_KINDS) else 0)
+        self.containers.append(symbol.get('containerName', '') or '')
+        self.file_ids.append(file_id)
+        self.lines.append(start['line'])
+        self.characters.append(start['character'])
+        self.alive.append(1)
+        self.file_symbols.setdefault(file_id, []).append(symbol_id)
+
+        for trigram in trigrams(lower_name):
+            postings = self.postings.get(trigram, None)
+            if None == postings:
+                postings = self.postings[trigram] = array('I')
+            postings.append(symbol_id)
+
+        self.sorted_names = None
+
+    def remove_files(self, paths: Iterable[str]):
+        with self.lock:
+            for path in paths:
+                self.__remove_file(path)
+
+            # too many dead entries slow the search down, rebuild the postings
+            if self.removed > len(self.names) // 2:
+                self.__compact()
+
+    def __remove_file(self, path: str):
+        file_id = self.files.path_ids.get(path, None)
+        if None == file_id:
+            return
+
+        for symbol_id in self.file_symbols.pop(file_id, []):
+            if self.alive[symbol_id]:
+                self.alive[symbol_id] = 0
+                self.removed += 1
+
+        self.sorted_names = None
+
+    def replace_file(self, path: str, symbols: list[dict]):
+        with self.lock:
+            self.__remove_file(path)
+            for symbol in symbols:
+                self.__add(symbol)
+
+    def __compact(self):
+        symbols = [self.__symbol(symbol_id) for symbol_id in range(len(self.names)) if self.alive[symbol_id]]
+        self.__reset()
+        for symbol in symbols:
+            self.__add(symbol)
+
+    def __symbol(self, symbol_id: int) -> dict:
+        # same shape as workspace/symbol results
+        return {
+            'name': self.names[symbol_id],
+            'kind': self.kinds[symbol_id],
+            'containerName': self.containers[symbol_id],
+            'location': {
+                'uri': clangd_utils.fn_to_uri(self.files.paths[self.file_ids[symbol_id]]),
+                'range': {
+                    'start': {'line': self.lines[symbol_id], 'character': self.characters[symbol_id]},
+                    'end': {'line': self.lines[symbol_id], 'character': self.characters[symbol_id]},
+                },
+            },
+        }
+
+    def __candidates(self, literals: list[str]) -> Union[Iterable[int], None]:
+        # smallest posting list first, none of the query trigrams means no match
+        grams = set()
+        for literal in literals:
+            grams |= trigrams(literal)
+
+        if not grams:
+            return None
+
+        lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+
+        # rarest trigram gives the candidates, posting lists are ascending so
+        # the others are probed by bisect instead of being walked
+        candidates = lists[0]
+        for postings in lists[1:]:
+            if len(candidates) <= NARROW_LIMIT:
+                break
+            candidates = [symbol_id for symbol_id in candidates if contains(postings, symbol_id)]
+
+        return candidates
+
+    def prepare(self):
+        # sort names ahead of the first prefix search, called after bulk loads
+        with self.lock:
+            self.__sort_names()
+
+    def __sort_names(self):
+        if None == self.sorted_names:
+            self.sorted_names = sorted((name, symbol_id) for symbol_id, name in
+                                       enumerate(self.lower_names) if self.alive[symbol_id])
+
+    def __prefix_candidates(self, prefix: str) -> list[int]:
+        self.__sort_names()
+
+        start = bisect.bisect_left(self.sorted_names, (prefix,))
+        end = bisect.bisect_left(self.sorted_names, (prefix + '\U0010ffff',))
+        return [symbol_id for _, symbol_id in self.sorted_names[start:end]]
+
+    def lookup(self, name: str) -> list[dict]:
+        # symbols named exactly name, in workspace/symbol shape
+        with self.lock:
+            candidates = self.__candidates([name.lower()])
+            if None == candidates:
+                candidates = range(len(self.names))
+
+            return [self.__symbol(symbol_id) for symbol_id in candidates
+                    if self.alive[symbol_id] and self.names[symbol_id] == name]
+
+    def search(self, query: str, mode: str = 'substring', kinds: list[str] = None,
+               limit: int = 50) -> tuple[int, list[dict]]:
+        if mode not in MODES:
+            raise RuntimeError(f'mode should be one of {', '.join(MODES)}')
+
+        kind_set = set(kind_number(kind) for kind in kinds) if kinds else None
+        lower_query = query.lower()
+
+        with self.lock:
+            names = self.lower_names
+            if 'regex' == mode:
+                try:
+                    pattern = re.compile(query, re.IGNORECASE)
+                except re.error as e:
+                    raise RuntimeError(f'invalid regex: {e}')
+
+                candidates = self.__candidates([literal.lower() for literal in regex_literals(query)])
+                names, test = self.names, pattern.search
+            elif 'prefix' == mode:
+                candidates = self.__prefix_candidates(lower_query)
+                test = None
+            elif 'fuzzy' == mode:
+                # characters of the query in order, possibly with gaps
+                candidates = None
+                test = re.compile('.*?'.join(map(re.escape, lower_query))).search
+            else:
+                candidates = self.__candidates([lower_query])
+                test = lambda name: lower_query in name
+
+            if None != candidates:
+                found = candidates if None == test else [symbol_id for symbol_id in candidates if test(names[symbol_id])]
+            elif 'substring' == mode:
+                # query too short for trigrams, check every name
+                found = [symbol_id for symbol_id, name in enumerate(names) if lower_query in name]
+            else:
+                found = [symbol_id for symbol_id, name in enumerate(names) if test(name)]
+
+            found = [symbol_id for symbol_id in found if self.alive[symbol_id]
+                     and (None == kind_set or self.kinds[symbol_id] in kind_set)]
+
+            total = len(found)
+            rank = lambda symbol_id: self.__rank(symbol_id, lower_query)
+            if limit > 0:
+                found = heapq.nsmallest(limit, found, key=rank)
+            else:
+                found.sort(key=rank)
+
+            return total, [self.__describe(symbol_id) for symbol_id in found]
+
+    def __rank(self, symbol_id: int, lower_query: str) -> tuple:
+        name = self.lower_names[symbol_id]
+        position = name.find(lower_query) if lower_query else -1
+
+        return (
+            name != lower_query,
+            position != 0,
+            # match at a word boundary of snake_case names
+            not (position > 0 and '_' == name[position - 1]),
+            len(name),
+            name,
+            symbol_id,
+        )
+
+    def __describe(self, symbol_id: int) -> dict:
+        return {
+            'name': self.names[symbol_id],
+            'kind': SYMBOL_KINDS[self.kinds[symbol_id]],
+            'container': self.containers[symbol_id],
+            'location': f'{self.files.relative(self.file_ids[symbol_id])}:{self.lines[symbol_id]}',
+        }
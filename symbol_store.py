@@ -0,0 +1,187 @@
+import hashlib
+import sqlite3
+import threading
+import os
+
+import clangd_utils
+
+# on-disk symbol database of a workspace, filled with workspace/symbol results.
+# every file is recorded with its content hash, rows of a file are only trusted
+# while the file content is unchanged, so a restart can answer from disk at once
+class SymbolStore:
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS symbols (
+            name TEXT NOT NULL,
+            kind INTEGER NOT NULL,
+            container TEXT NOT NULL,
+            path TEXT NOT NULL,
+            line INTEGER NOT NULL,
+            character INTEGER NOT NULL,
+            UNIQUE (name, path, line, character)
+        );
+        CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+        CREATE INDEX IF NOT EXISTS symbols_path ON symbols (path);
+    '''
+    # files written per transaction by update
+    BATCH_FILES = 256
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # store is accessed from worker threads, serialize it by a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(self.SCHEMA)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def __is_valid(self, path: str) -> bool:
+        row = self.db.execute('SELECT hash, mtime, size FROM files WHERE path = ?', (path,)).fetchone()
+
+        # file never recorded
+        if None == row:
+            return False
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        # unchanged since recorded, skip hashing
+        if (stat.st_mtime_ns, stat.st_size) == (row[1], row[2]):
+            return True
+
+        # file touched, compare content
+        if self.file_hash(path) != row[0]:
+            return False
+
+        self.db.execute('UPDATE files SET mtime = ?, size = ? WHERE path = ?',
+                        (stat.st_mtime_ns, stat.st_size, path))
+        self.db.commit()
+        return True
+
+    def lookup(self, name: str) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name, kind, container, path, line, character FROM symbols '
+                'WHERE name = ? ORDER BY rowid', (name,)).fetchall()
+
+            # every file contributing to the answer must be unchanged,
+            # otherwise the answer should be revalidated by clangd
+            for path in set(row[3] for row in rows):
+                if not self.__is_valid(path):
+                    return []
+
+        return [{
+            'name': name,
+            'kind': kind,
+            'containerName': container,
+            'location': {
+                'uri': clangd_utils.fn_to_uri(path),
+                'range': {
+                    'start': {'line': line, 'character': character},
+                    'end': {'line': line, 'character': character},
+                },
+            },
+        } for name, kind, container, path, line, character in rows]
+
+    def all(self) -> list[dict]:
+        # rows are not validated here, callers refresh them from clangd later
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT name, kind, container, path, line, character FROM symbols ORDER BY rowid').fetchall()
+
+        return [{
+            'name': name,
+            'kind': kind,
+            'containerName': container,
+            'location': {
+                'uri': clangd_utils.fn_to_uri(path),
+                'range': {
+                    'start': {'line': line, 'character': character},
+                    'end': {'line': line, 'character': character},
+                },
+            },
+        } for name, kind, container, path, line, character in rows]
+
+    def update(self, symbols: list[dict], fetch_time: int = 0, names: list[str] = None):
+        # symbols are every symbol of the files they are in, or with names
+        # given, every symbol of those names. rows they replace might be left
+        # from a partial index, such as a prototype found before the definition
+        files: dict[str, list[dict]] = {}
+
+        for symbol in symbols:
+            files.setdefault(clangd_utils.uri_to_fn(symbol['location']['uri']), []).append(symbol)
+
+        items = list(files.items())
+        # lookups wait for the lock, so a big snapshot is written in batches
+        for begin in range(0, max(1, len(items)), self.BATCH_FILES):
+            batch = items[begin:begin + self.BATCH_FILES]
+
+            with self.lock:
+                rows = {path: self.db.execute('SELECT hash, mtime, size FROM files WHERE path = ?', (path,)).fetchone()
+                        for path, _ in batch}
+
+            # hash outside the lock, files unchanged since recorded are not read again
+            stamps: dict[str, tuple[str, int, int]] = {}
+            for path, _ in batch:
+                try:
+                    stat = os.stat(path)
+                    # modified after clangd reported the symbols, they might be outdated
+                    if fetch_time and stat.st_mtime_ns > fetch_time:
+                        continue
+
+                    row = rows[path]
+                    if None != row and (stat.st_mtime_ns, stat.st_size) == (row[1], row[2]):
+                        content_hash = row[0]
+                    else:
+                        content_hash = self.file_hash(path)
+                except OSError:
+                    continue
+
+                stamps[path] = (content_hash, stat.st_mtime_ns, stat.st_size)
+
+            with self.lock:
+                if None != names and 0 == begin:
+                    self.db.executemany('DELETE FROM symbols WHERE name = ?', [(name,) for name in names])
+
+                for path, file_symbols in batch:
+                    if path not in stamps:
+                        continue
+
+                    content_hash, mtime, size = stamps[path]
+                    row = self.db.execute('SELECT hash FROM files WHERE path = ?', (path,)).fetchone()
+
+                    # content changed, rows of this file are outdated
+                    if None == names or None == row or row[0] != content_hash:
+                        self.db.execute('DELETE FROM symbols WHERE path = ?', (path,))
+
+                    self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, content_hash, mtime, size))
+
+                    self.db.executemany('INSERT OR IGNORE INTO symbols VALUES (?, ?, ?, ?, ?, ?)', [(
+                        symbol['name'],
+                        symbol['kind'],
+                        symbol.get('containerName', '') or '',
+                        path,
+                        symbol['location']['range']['start']['line'],
+                        symbol['location']['range']['start']['character'],
+                    ) for symbol in file_symbols])
+
+                self.db.commit()
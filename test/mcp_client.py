@@ -70,14 +70,20 @@ test_cases = {
     'nt': [
         ('start_analyzer', {"workspace_path": workspace}),
         ('start_analyzer', {"workspace_path": workspace}),
+        ('analyzer_status', {}),
         ('find_references', {"symbol_name": "console_update"}),
         ('find_references', {"symbol_name": "console_send_str"}),
+        ('find_references', {"symbol_name": "console_send_str", "limit": 5, "group_by_file": True}),
         ('find_definition', {"symbol_name": "console_update"}),
         ('find_definition', {"symbol_name": "map_search"}),
         ('find_definition', {"symbol_name": "main"}),
+        ('batch_find_definitions', {"symbol_names": ["console_update", "map_search", "main"]}),
+        ('batch_find_references', {"symbol_names": ["console_update", "console_send_str"]}),
+        ('call_hierarchy', {"symbol_name": "console_update", "depth": 3}),
     ],
     'posix': [
         ('start_analyzer', {"workspace_path": "/workspace/proj/baseband/macsw/"}),
+        ('analyzer_status', {}),
         ('find_references', {"symbol_name": "rwnx_platform_init"}),
         ('find_definition', {"symbol_name": "rxl_mpdu_isr"}),
     ]
@@ -0,0 +1,38 @@
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import ResultCache
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'a.c')
+        with open(self.path, 'w') as f:
+            f.write('int a;\n')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def touch(self):
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    def test_modified_file_invalidates(self):
+        cache = ResultCache()
+        cache.put('key', ['a.c:0'], [self.path])
+        self.assertEqual(cache.get('key'), ['a.c:0'])
+        self.touch()
+        self.assertIsNone(cache.get('key'))
+
+    def test_files_are_not_checked_while_watched(self):
+        cache = ResultCache()
+        cache.check_files = False
+        cache.put('key', ['a.c:0'], [self.path])
+        self.touch()
+        self.assertEqual(cache.get('key'), ['a.c:0'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdb import CompileDatabase, command_arguments
+
+class CommandArgumentsTest(unittest.TestCase):
+    def test_arguments_are_taken_as_is(self):
+        entry = {'arguments': ['clang', '-Iinc', 'a.c'], 'command': 'ignored'}
+        self.assertEqual(command_arguments(entry, windows=True), ['clang', '-Iinc', 'a.c'])
+
+    def test_posix_command(self):
+        entry = {'command': 'clang -DNAME="a b" -I/usr/inc a.c'}
+        self.assertEqual(command_arguments(entry, windows=False), ['clang', '-DNAME=a b', '-I/usr/inc', 'a.c'])
+
+    def test_windows_command_keeps_backslashes(self):
+        entry = {'command': r'C:\llvm\bin\clang.exe -IC:\proj\inc "C:\Program Files\sdk\a.c"'}
+        self.assertEqual(command_arguments(entry, windows=True),
+                         [r'C:\llvm\bin\clang.exe', r'-IC:\proj\inc', r'C:\Program Files\sdk\a.c'])
+
+class CompileDatabaseTest(unittest.TestCase):
+    def test_truncated_entry_is_skipped(self):
+        # a build tool might still be writing the file, the last string is not closed
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'compile_commands.json')
+            with open(path, 'wb') as f:
+                f.write(b'[{"directory": "/w", "file": "a.c", "command": "cc a.c"},\n'
+                        b' {"directory": "/w", "file": "' + b'b' * 64)
+
+            cdb = CompileDatabase(path)
+            cdb.build_index()
+            self.assertEqual(cdb.files, [os.path.normpath('/w/a.c')])
+            self.assertEqual(cdb.entry_for('/w/a.c')['command'], 'cc a.c')
+            cdb.close()
+
+if __name__ == '__main__':
+    unittest.main()
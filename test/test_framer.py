@@ -0,0 +1,27 @@
+import os, sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from clangd_utils import MessageFramer, encode_message
+
+class MessageFramerTest(unittest.TestCase):
+    def test_small_payload_is_decoded(self):
+        framer = MessageFramer()
+        messages, logs = framer.feed(b'log line\n' + encode_message({'id': 1}))
+        self.assertEqual(messages, [{'id': 1}])
+        self.assertEqual(logs, ['log line'])
+
+    def test_large_payload_is_left_encoded(self):
+        framer = MessageFramer()
+        message = {'id': 2, 'result': ['x' * 64] * (MessageFramer.LARGE_PAYLOAD // 64)}
+        data = encode_message(message)
+        # split across reads
+        self.assertEqual(framer.feed(data[:100]), ([], []))
+        messages, _ = framer.feed(data[100:])
+        self.assertIsInstance(messages[0], bytes)
+        self.assertEqual(json.loads(messages[0]), message)
+
+if __name__ == '__main__':
+    unittest.main()
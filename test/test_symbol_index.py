@@ -0,0 +1,44 @@
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from symbol_index import SymbolIndex, regex_literals
+
+def make_symbol(name: str, kind: int = 12, line: int = 0) -> dict:
+    return {
+        'name': name,
+        'kind': kind,
+        'containerName': '',
+        'location': {
+            'uri': 'file:///ws/src/a.c',
+            'range': {'start': {'line': line, 'character': 0}, 'end': {'line': line, 'character': 0}},
+        },
+    }
+
+class RegexLiteralsTest(unittest.TestCase):
+    def test_bounded_repeat_is_not_a_literal(self):
+        self.assertEqual(regex_literals('foo{0,1}bar'), ['bar'])
+        self.assertEqual(regex_literals('net_{2}send'), ['net', 'send'])
+
+    def test_character_class_is_not_a_literal(self):
+        self.assertEqual(regex_literals('net[_a-z]send'), ['net', 'send'])
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SymbolIndex('/ws')
+        self.index.add([make_symbol('fobar', line=1), make_symbol('foobar', line=2), make_symbol('fooobar', line=3),
+                        make_symbol('ELOOP', kind=15, line=4)])
+
+    def test_bounded_repeat_query(self):
+        total, result = self.index.search('^fo{1,2}bar$', 'regex')
+        self.assertEqual(total, 2)
+        self.assertEqual(sorted(symbol['name'] for symbol in result), ['fobar', 'foobar'])
+
+    def test_macros_are_searchable_by_kind(self):
+        total, result = self.index.search('eloop', kinds=['macro'])
+        self.assertEqual(total, 1)
+        self.assertEqual(result[0]['kind'], 'macro')
+
+if __name__ == '__main__':
+    unittest.main()
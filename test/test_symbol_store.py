@@ -0,0 +1,56 @@
+import os, sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import clangd_utils
+from symbol_store import SymbolStore
+
+def symbol(name: str, path: str, line: int) -> dict:
+    return {'name': name, 'kind': 12, 'containerName': '', 'location': {
+        'uri': clangd_utils.fn_to_uri(path),
+        'range': {'start': {'line': line, 'character': 0}, 'end': {'line': line, 'character': 0}},
+    }}
+
+class CountingStore(SymbolStore):
+    hashed = 0
+
+    @classmethod
+    def file_hash(cls, path: str) -> str:
+        cls.hashed += 1
+        return SymbolStore.file_hash(path)
+
+class SymbolStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = CountingStore(os.path.join(self.tmp.name, 'symbols.db'))
+        self.store.BATCH_FILES = 2
+        self.paths = []
+        for n in range(5):
+            path = os.path.join(self.tmp.name, f'f{n}.c')
+            with open(path, 'w') as f:
+                f.write(f'int f{n};\n')
+            self.paths.append(path)
+        CountingStore.hashed = 0
+
+    def tearDown(self):
+        self.store.close()
+        self.tmp.cleanup()
+
+    def test_snapshot_replaces_rows(self):
+        self.store.update([symbol(f'f{n}', path, 0) for n, path in enumerate(self.paths)])
+        self.store.update([symbol('g0', self.paths[0], 1)])
+        self.assertEqual(self.store.lookup('f0'), [])
+        self.assertEqual(len(self.store.lookup('g0')), 1)
+        self.assertEqual(len(self.store.lookup('f4')), 1)
+
+    def test_unchanged_files_are_not_hashed_again(self):
+        symbols = [symbol(f'f{n}', path, 0) for n, path in enumerate(self.paths)]
+        self.store.update(symbols)
+        self.assertEqual(CountingStore.hashed, 5)
+        self.store.update(symbols)
+        self.assertEqual(CountingStore.hashed, 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,23 @@
 from pydantic import BaseModel, Field
 from functools import wraps
-from typing import Callable
-from clangd import ClangdClient
+from typing import Callable, ClassVar
+import asyncio
+from clangd import ClangdClientPool, deadline
+from symbol_index import SymbolFilter
+import clangd_utils
 
-client = ClangdClient()
+# one analyzer per workspace, least recently used ones are stopped
+pool = ClangdClientPool(int(clangd_utils.get_option('max-workspaces', '2')),
+                        # --standby=on keeps a spare clangd for fast restarts
+                        standby='on' == clangd_utils.get_option('standby', 'off'),
+                        # no single clangd request waits longer than this
+                        request_timeout=float(clangd_utils.get_option('request-timeout', '60')),
+                        # --watch=off leaves edited files stale until a restart
+                        watch='off' != clangd_utils.get_option('watch', 'on'),
+                        # least recently used documents are closed above this count
+                        max_opened_files=int(clangd_utils.get_option('max-opened-files', '32')),
+                        # --max-memory-mb closes idle documents when clangd uses more, 0 means no limit
+                        max_memory_mb=int(clangd_utils.get_option('max-memory-mb', '0')))
 
 
 # accept original function
@@ -18,46 +32,234 @@ def unwrap_arg(fun: Callable) -> Callable:
 
         sign = inspect.signature(fun)
 
-        for name, _ in sign.parameters.items():
-            arg_list.append(args[name])
+        for name, param in sign.parameters.items():
+            # optional arg might be omitted by the caller
+            if param.default is inspect.Parameter.empty:
+                arg_list.append(args[name])
+            else:
+                arg_list.append(args.get(name, param.default))
 
         return fun(*arg_list)
     return wrapper
 
+# attach index state so the caller knows whether the answer might be incomplete
+def with_index_flag(client, result):
+    return {
+        'index_complete': client.index_complete(),
+        'result': result,
+    }
+
+WORKSPACE_DESC = 'absolute path of a started workspace, the most recently used one if omitted'
+TIMEOUT_DESC = 'seconds to wait for the analyzer, a timed out lookup is reported as an error'
+KINDS_DESC = 'only symbols of these kinds, such as function, struct, variable, field, method, class'
+FILE_GLOB_DESC = 'only symbols in files matching this glob, such as src/net/*.c, a glob without / matches the file name'
+CONTAINER_DESC = 'only symbols in this namespace, class or struct, symbol_name might be qualified like ns::name as well'
+
 class start_analyzer(BaseModel):
-    """Start the code analyzer in a workspace"""
+    """Start the code analyzer in a workspace, it returns before the background index is done"""
     workspace_path: str = Field(description='absolute path to the current workspace')
+    wait_for_index: bool = Field(default=False, description='wait until the background index is complete')
+    shards: int = Field(default=1, description='split the workspace by top level directory and run one backend process per shard, only useful for huge workspaces')
 
     @unwrap_arg
     @staticmethod
-    async def exec(workspace_path):
-        await client.start(workspace_path)
+    async def exec(workspace_path, wait_for_index: bool = False, shards: int = 1):
+        client = await pool.start(workspace_path, shards)
+
+        if wait_for_index:
+            await client.wait_for_background_index_down()
 
 class stop_analyzer(BaseModel):
     """Stop the code analyzer"""
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
 
     @unwrap_arg
     @staticmethod
-    async def exec():
-        await client.stop()
+    async def exec(workspace_path: str = ''):
+        await pool.stop(workspace_path)
 
 class find_definition(BaseModel):
-    """Find definition position of a symbol"""
+    """Find definition positions of a symbol, every symbol of the name is returned unless narrowed down by kinds, file_glob or container"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
     symbol_name: str = Field(description='function name or variable name')
+    kinds: list[str] = Field(default=[], description=KINDS_DESC)
+    file_glob: str = Field(default='', description=FILE_GLOB_DESC)
+    container: str = Field(default='', description=CONTAINER_DESC)
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+    timeout: float = Field(default=20, description=TIMEOUT_DESC)
 
     @unwrap_arg
     @staticmethod
-    async def exec(symbol_name: str) -> list[str]:
-        return await client.find_symbol_definition(symbol_name)
+    async def exec(symbol_name: str, kinds: list[str] = [], file_glob: str = '', container: str = '',
+                   workspace_path: str = '', timeout: float = 20) -> dict:
+        client = pool.get(workspace_path)
+        symbol_filter = SymbolFilter(kinds, file_glob, container)
+        with deadline(timeout):
+            return with_index_flag(client, await client.find_symbol_definition(symbol_name, symbol_filter))
 
 class find_references(BaseModel):
-    """Find all reference of a symbol"""
-    symbol_name: str = Field(description='function name or variable name')
+    """Find all reference of a symbol, large results are returned page by page, pass next_cursor of a page to get the next one"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    symbol_name: str = Field(default='', description='function name or variable name, not needed when cursor is given')
+    limit: int = Field(default=500, description='max number of entries in a page, 0 for all of them')
+    offset: int = Field(default=0, description='index of the first entry of the page')
+    cursor: str = Field(default='', description='next_cursor of the previous page')
+    group_by_file: bool = Field(default=False, description='return one entry with the reference count and lines per file')
+    kinds: list[str] = Field(default=[], description=KINDS_DESC)
+    file_glob: str = Field(default='', description=FILE_GLOB_DESC)
+    container: str = Field(default='', description=CONTAINER_DESC)
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+    timeout: float = Field(default=60, description=TIMEOUT_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(symbol_name: str = '', limit: int = 500, offset: int = 0, cursor: str = '',
+                   group_by_file: bool = False, kinds: list[str] = [], file_glob: str = '',
+                   container: str = '', workspace_path: str = '', timeout: float = 60) -> dict:
+        client = pool.get(workspace_path)
+        symbol_filter = SymbolFilter(kinds, file_glob, container)
+        with deadline(timeout):
+            page = await client.page_symbol_references(symbol_name, limit, offset, cursor, group_by_file,
+                                                       symbol_filter)
+        return {**with_index_flag(client, page.pop('result')), **page}
+
+class batch_find_definitions(BaseModel):
+    """Find definition positions of many symbols in one call"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    symbol_names: list[str] = Field(description='function names or variable names')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+    timeout: float = Field(default=120, description=TIMEOUT_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(symbol_names: list[str], workspace_path: str = '', timeout: float = 120) -> dict:
+        client = pool.get(workspace_path)
+        # symbols not resolved in time are reported in errors
+        with deadline(timeout):
+            found, errors = await client.batch_find_symbol_definition(symbol_names)
+        return {**with_index_flag(client, found), 'errors': errors}
+
+class batch_find_references(BaseModel):
+    """Find all references of many symbols in one call"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    symbol_names: list[str] = Field(description='function names or variable names')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+    timeout: float = Field(default=120, description=TIMEOUT_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(symbol_names: list[str], workspace_path: str = '', timeout: float = 120) -> dict:
+        client = pool.get(workspace_path)
+        # symbols not resolved in time are reported in errors
+        with deadline(timeout):
+            found, errors = await client.batch_find_symbol_references(symbol_names)
+        return {**with_index_flag(client, found), 'errors': errors}
+
+class search_symbols(BaseModel):
+    """Search symbols of the workspace by part of their name, answered from a local index without asking the analyzer"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    query: str = Field(description='text or pattern to search for, case insensitive')
+    mode: str = Field(default='substring', description='substring, prefix, regex, or fuzzy for the characters of query in order')
+    kinds: list[str] = Field(default=[], description='only return symbols of these kinds, such as function, struct, variable, field, enum_member, macro')
+    limit: int = Field(default=50, description='max number of symbols to return, 0 for all of them')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(query: str, mode: str = 'substring', kinds: list[str] = [], limit: int = 50,
+                   workspace_path: str = '') -> dict:
+        client = pool.get(workspace_path)
+        total, result = await client.search_symbols(query, mode, kinds, limit)
+        # symbols are complete once the index has been loaded from the analyzer
+        return {'index_complete': client.symbol_index_ready, 'result': result, 'total': total}
+
+class call_hierarchy(BaseModel):
+    """Get the callers or callees of a function several levels deep as a graph, edges are [caller, callee, call sites] with node indexes"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    symbol_name: str = Field(description='function name')
+    direction: str = Field(default='incoming', description='incoming for callers, outgoing for callees, both for both of them')
+    depth: int = Field(default=2, description='number of levels to expand')
+    max_nodes: int = Field(default=200, description='stop adding functions once the graph has this many of them')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+    timeout: float = Field(default=60, description=TIMEOUT_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(symbol_name: str, direction: str = 'incoming', depth: int = 2, max_nodes: int = 200,
+                   workspace_path: str = '', timeout: float = 60) -> dict:
+        client = pool.get(workspace_path)
+        with deadline(timeout):
+            return with_index_flag(client, await client.call_hierarchy(symbol_name, direction, depth, max_nodes))
+
+class build_call_graph(BaseModel):
+    """Build the call graph of the whole workspace in background for query_call_graph, every function in the compile database is visited so it takes a while on large code bases"""
+    wait: bool = Field(default=False, description='wait until the call graph is built')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(wait: bool = False, workspace_path: str = '') -> dict:
+        client = pool.get(workspace_path)
+        task = client.build_program_graph()
+
+        if wait:
+            await asyncio.shield(task)
+
+        return client.program_graph_status()
+
+class query_call_graph(BaseModel):
+    """Query the call graph built by build_call_graph, answers reachability and ranking questions over the whole workspace at once"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    query: str = Field(description='reachable_from: functions called by the function directly or indirectly, '
+                                   'can_reach: functions calling the function directly or indirectly, '
+                                   'fan_in: functions called from most places, fan_out: functions calling most functions')
+    symbol_name: str = Field(default='', description='function name, needed by reachable_from and can_reach')
+    depth: int = Field(default=0, description='max number of calls between the functions, 0 for no limit')
+    limit: int = Field(default=50, description='max number of functions to return, 0 for all of them')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(query: str, symbol_name: str = '', depth: int = 0, limit: int = 50, workspace_path: str = '') -> dict:
+        return await pool.get(workspace_path).query_program_graph(query, symbol_name, depth, limit)
+
+class get_compile_command(BaseModel):
+    """Get the compile command of a source file from the compile database"""
+    # read only, identical concurrent calls share one execution
+    coalesce: ClassVar[bool] = True
+    file_path: str = Field(description='path of the source file, absolute or relative to the workspace')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(file_path: str, workspace_path: str = '') -> dict:
+        return await pool.get(workspace_path).get_compile_command(file_path)
+
+class analyzer_status(BaseModel):
+    """Get the code analyzer status, including the background index progress and the started workspaces"""
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
+
+    @unwrap_arg
+    @staticmethod
+    async def exec(workspace_path: str = '') -> dict:
+        return pool.get_status(workspace_path)
+
+class get_analyzer_log(BaseModel):
+    """Get the latest log lines of the code analyzer backend, useful for debugging"""
+    lines: int = Field(default=100, description='number of latest log lines to return')
+    workspace_path: str = Field(default='', description=WORKSPACE_DESC)
 
     @unwrap_arg
     @staticmethod
-    async def exec(symbol_name: str) -> list[str]:
-        return await client.find_symbol_references(symbol_name)
+    async def exec(lines: int = 100, workspace_path: str = '') -> list[str]:
+        return pool.get(workspace_path).get_clangd_log(lines)
 
 
 tool_list: list[BaseModel] = [
@@ -65,4 +267,13 @@ tool_list: list[BaseModel] = [
     stop_analyzer,
     find_definition,
     find_references,
+    batch_find_definitions,
+    batch_find_references,
+    search_symbols,
+    call_hierarchy,
+    build_call_graph,
+    query_call_graph,
+    get_compile_command,
+    analyzer_status,
+    get_analyzer_log,
 ]
@@ -0,0 +1,329 @@
+from typing import Awaitable, Callable, Union
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+import time
+
+import clangd_utils
+
+# lsp file change types
+CREATED, CHANGED, DELETED = 1, 2, 3
+
+# files clangd cares about, anything else is not reported
+WATCHED_EXTENSIONS = {
+    '.c', '.h', '.cc', '.cpp', '.cxx', '.c++', '.hh', '.hpp', '.hxx', '.h++',
+    '.inc', '.inl', '.ipp', '.tcc', '.m', '.mm', '.cu', '.cuh',
+}
+WATCHED_NAMES = {clangd_utils.CDB_NAME, '.clangd'}
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+# wd, mask, cookie, name length, followed by the name
+EVENT_HEADER = struct.Struct('iIII')
+
+def is_watched(path: str) -> bool:
+    name = os.path.basename(path)
+    return name in WATCHED_NAMES or os.path.splitext(name)[1].lower() in WATCHED_EXTENSIONS
+
+def is_ignored_dir(name: str) -> bool:
+    # .git, .cache and so on change all the time but never hold sources
+    return name.startswith('.') or name in clangd_utils.CDB_IGNORED_DIRS
+
+def walk_dirs(root: str):
+    for directory, dirs, files in os.walk(root):
+        dirs[:] = [name for name in dirs if not is_ignored_dir(name)]
+        yield directory, files
+
+def load_libc() -> Union[ctypes.CDLL, None]:
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+# reports changed source files of a workspace in batches, by inotify on linux
+# and by comparing mtimes of a periodic scan elsewhere or when inotify runs out
+# of watches. on_change gets path -> change type, or None when events were lost.
+# triggers are extra files reported as well, such as git HEAD
+class FileWatcher:
+    def __init__(self, root: str, on_change: Callable[[Union[dict[str, int], None]], Awaitable],
+                 logger: logging.Logger, delay: float = 0.2, interval: float = 2,
+                 triggers: list[str] = None):
+        self.root = root
+        self.triggers = set(triggers or [])
+        self.on_change = on_change
+        self.logger = logger
+        # events within delay are reported together, a save is several events
+        self.delay = delay
+        # least seconds between two scans when polling
+        self.interval = interval
+        self.mode = 'off'
+
+        self.fd = -1
+        # watch descriptor -> directory
+        self.watches: dict[int, str] = {}
+        # watches of trigger directories, nothing else in them is reported
+        self.trigger_watches: set[int] = set()
+        self.poll_task: asyncio.Task = None
+
+        self.pending: dict[str, int] = {}
+        self.overflowed = False
+        self.flush_handle: asyncio.TimerHandle = None
+        # batches are delivered one after another
+        self.deliver_lock = asyncio.Lock()
+        self.deliver_tasks: set[asyncio.Task] = set()
+        self.changes = 0
+
+    async def start(self):
+        libc = load_libc()
+
+        if None != libc:
+            try:
+                await asyncio.to_thread(self.__start_inotify, libc)
+                asyncio.get_running_loop().add_reader(self.fd, self.__on_readable)
+                self.mode = 'inotify'
+                return
+            except OSError as e:
+                self.logger.warning(f'inotify is not usable, poll files instead: {e}')
+                self.__close_inotify()
+
+        self.poll_task = asyncio.create_task(self.__poll(), name='poll_task')
+        self.mode = 'polling'
+
+    def stop(self):
+        if None != self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if self.fd >= 0:
+            asyncio.get_running_loop().remove_reader(self.fd)
+        self.__close_inotify()
+
+        if None != self.poll_task:
+            self.poll_task.cancel()
+            self.poll_task = None
+
+        for task in self.deliver_tasks:
+            task.cancel()
+
+        self.pending.clear()
+        self.mode = 'off'
+
+    def get_status(self) -> dict:
+        return {
+            'mode': self.mode,
+            'watched_dirs': len(self.watches),
+            'changes': self.changes,
+        }
+
+    def __start_inotify(self, libc: ctypes.CDLL):
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        for directory, _ in walk_dirs(self.root):
+            self.__add_watch(directory)
+
+        for directory in set(os.path.dirname(path) for path in self.triggers):
+            if directory in self.watches.values():
+                continue
+
+            try:
+                self.trigger_watches.add(self.__add_watch(directory))
+            except OSError as e:
+                self.logger.warning(f'trigger is not watched: {e}')
+
+    def __close_inotify(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+        self.watches.clear()
+        self.trigger_watches.clear()
+
+    def __add_watch(self, directory: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_MASK)
+
+        # ENOSPC means fs.inotify.max_user_watches is used up
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f'watch {directory}: {os.strerror(errno)}')
+
+        self.watches[wd] = directory
+        return wd
+
+    def __on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+
+            # kernel queue was full, some events are gone
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+
+            directory = self.watches.get(wd, None)
+            if None == directory:
+                continue
+
+            # directory removed, its watch is gone with it
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+
+            path = os.path.join(directory, name)
+
+            if path in self.triggers:
+                self.__record(path, CHANGED)
+                continue
+
+            if wd in self.trigger_watches:
+                continue
+
+            if mask & IN_ISDIR:
+                if is_ignored_dir(name):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.__watch_new_dir(path)
+                elif mask & IN_MOVED_FROM:
+                    # files moved away with the directory are not reported one by one
+                    self.overflowed = True
+                continue
+
+            if not name or not is_watched(path):
+                continue
+
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                self.__record(path, DELETED)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.__record(path, CREATED)
+            else:
+                self.__record(path, CHANGED)
+
+        self.__schedule()
+
+    def __watch_new_dir(self, path: str):
+        # files might be written before the watch is added, report them all
+        try:
+            for directory, files in walk_dirs(path):
+                self.__add_watch(directory)
+                for name in files:
+                    if is_watched(name):
+                        self.__record(os.path.join(directory, name), CREATED)
+        except OSError as e:
+            self.logger.warning(f'watch new directory failed: {e}')
+            self.overflowed = True
+
+    def __record(self, path: str, change: int):
+        previous = self.pending.get(path, None)
+
+        # created then written is still a new file
+        if CREATED == previous and CHANGED == change:
+            return
+        # replaced by a new file, such as an editor saving by rename
+        if DELETED == previous and CREATED == change:
+            change = CHANGED
+
+        self.pending[path] = change
+
+    def __schedule(self):
+        if (self.pending or self.overflowed) and None == self.flush_handle:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.delay, self.__flush)
+
+    def __flush(self):
+        self.flush_handle = None
+
+        changes = None if self.overflowed else self.pending
+        self.pending = {}
+        self.overflowed = False
+        self.changes += len(changes or ())
+
+        task = asyncio.create_task(self.__deliver(changes), name='deliver_task')
+        self.deliver_tasks.add(task)
+        task.add_done_callback(self.deliver_tasks.discard)
+
+    async def __deliver(self, changes: Union[dict[str, int], None]):
+        async with self.deliver_lock:
+            try:
+                await self.on_change(changes)
+            except Exception as e:
+                self.logger.warning(f'handle file changes failed: {e}')
+
+    def __scan(self) -> dict[str, tuple[int, int]]:
+        stamps = {}
+
+        for directory, files in walk_dirs(self.root):
+            for name in files:
+                if not is_watched(name):
+                    continue
+
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+
+        for path in self.triggers:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stamps[path] = (stat.st_mtime_ns, stat.st_size)
+
+        return stamps
+
+    async def __poll(self):
+        began = time.monotonic()
+        stamps = await asyncio.to_thread(self.__scan)
+        elapsed = time.monotonic() - began
+
+        while True:
+            # huge trees are scanned less often, scanning takes a fraction of the time
+            await asyncio.sleep(max(self.interval, elapsed * 4))
+
+            began = time.monotonic()
+            current = await asyncio.to_thread(self.__scan)
+            elapsed = time.monotonic() - began
+
+            for path, stamp in current.items():
+                previous = stamps.get(path, None)
+                if None == previous:
+                    self.__record(path, CREATED)
+                elif previous != stamp:
+                    self.__record(path, CHANGED)
+
+            for path in stamps.keys() - current.keys():
+                self.__record(path, DELETED)
+
+            stamps = current
+            self.__schedule()